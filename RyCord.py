@@ -8,11 +8,32 @@ import json
 import uuid
 import base64
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+import io
+import shutil
+import socket
+import time
+import queue
+import asyncio
+import argparse
+import gzip
+import sys
+import re
+import selectors
+import signal
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
 from datetime import datetime
-from threading import Lock
+from array import array
+from collections import deque, OrderedDict
+from bisect import bisect_left, bisect_right
+from itertools import count, islice, repeat
+from heapq import heapify, heappop, heappush, heapreplace, merge
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Thread, Event, BoundedSemaphore, Condition, get_ident, active_count
 import hashlib
+import math
 import random
 
 # ADMIN PASSWORD - Change this to your desired admin password
@@ -29,90 +50,3275 @@ CHANNELS_FILE = os.path.join(DATA_DIR, "channels.json")
 BANNED_USERS_FILE = os.path.join(DATA_DIR, "bannedusers.json")
 RESTRICTED_FILE = os.path.join(DATA_DIR, "restricted.json")
 FILES_DIR = os.path.join(DATA_DIR, "files")
+MESSAGES_DIR = os.path.join(DATA_DIR, "messages")
+UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+BLOBS_DIR = os.path.join(FILES_DIR, "blobs")
+SEARCH_FILE = os.path.join(DATA_DIR, "search.idx")
+SNAPSHOT_FILE = os.path.join(DATA_DIR, "snapshot.bin")
+LIMITS_FILE = os.path.join(DATA_DIR, "limits.json")
+MODERATION_FILE = os.path.join(DATA_DIR, "moderation.log")
+
+# Upload tuning
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_BUFFER_SIZE = 64 * 1024
+UPLOAD_EXPIRY = 24 * 60 * 60
+UPLOAD_JSON_OVERHEAD = 64 * 1024
+
+# Download tuning
+FILE_META_CACHE_SIZE = 4096
+FILE_CACHE_MAX_AGE = 3600
+
+# Seconds an unreferenced blob is kept before garbage collection removes it
+BLOB_GC_GRACE = 300
+
+# Static assets
+STATIC_FILES = ["index.html", "admin.html", "styles.css", "admin-styles.css", "app.js", "admin.js"]
+STATIC_CHECK_INTERVAL = 1
+GZIP_MIN_SIZE = 512
+
+# Encoded /api/messages, /api/channels and /api/users responses kept for reuse
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Message log tuning
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+MAX_SEGMENTS = 8
+COMPACT_INTERVAL = 60
+COMPACT_GARBAGE_RATIO = 0.5
+LOG_CHECKPOINT_EVERY = 256
+
+# Admin changes journaled before the channel and moderation files are rewritten
+MODERATION_JOURNAL_MAX = 1000
+
+# Messages per channel kept in memory; older history is read from the log
+HOT_HISTORY = 5000
+
+# Message fetch tuning
+MAX_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+MAX_TRACKED_DELETIONS = 1000
+
+# Sessions expire after this long without a heartbeat or request
+SESSION_TTL = 24 * 3600
+MAX_SESSIONS = 100000
+MAX_SESSIONS_PER_USER = 32
+
+# Server push tuning
+PRESENCE_TIMEOUT = 10
+MAX_LONG_POLL = 30
+STREAM_KEEPALIVE = 15
+STREAM_PRESENCE_CHECK = 5
+
+# Durability: "strict" (a request returns once its change is on disk),
+# "interval" (changes are written every FLUSH_INTERVAL_MS) or "shutdown"
+# (only written when the server stops)
+DURABILITY = "interval"
+FLUSH_INTERVAL_MS = 50
+
+# Server engine: "threadpool", "asyncio" or "threads" (one thread per request)
+SERVER_ENGINE = "threadpool"
+WORKER_THREADS = 32
+REQUEST_QUEUE_SIZE = 128
+MAX_STREAMS = WORKER_THREADS // 2
+REQUEST_TIMEOUT = 30
+
+# Server processes sharing the port through SO_REUSEPORT; with more than one,
+# the parent process runs the broker and owns the data files
+PROCESSES = 1
+
+# Admission control: [requests per second, burst] token buckets for each
+# session, user and client IP per route class (None for no limit), and caps
+# on concurrent uploads and on request body bytes held in memory at once.
+# The admin panel's Limits tab changes these while the server runs.
+RATE_LIMITS = {
+    "auth": {"session": None, "user": [0.2, 10], "ip": [1, 30]},
+    "send": {"session": [5, 30], "user": [10, 60], "ip": [50, 300]},
+    "upload": {"session": [0.5, 10], "user": [1, 20], "ip": [5, 50]},
+    "read": {"session": None, "user": None, "ip": [100, 500]}
+}
+MAX_CONCURRENT_UPLOADS = 8
+MAX_BODY_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+MAX_JSON_BODY = 1024 * 1024
+RATE_LIMIT_BUCKETS = 100000
+
+# Metrics: latency histogram bucket bounds in seconds, and the sampling profiler
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_STACKS = 2000
 
 # Create data directories
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(FILES_DIR, exist_ok=True)
+os.makedirs(MESSAGES_DIR, exist_ok=True)
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+
+channels = {}
+registered_users = {}
+users_loaded = Event()
+banned_users = set()
+# Restricted usernames per channel, and the same the other way round
+restricted_channels = {}
+user_restrictions = {}
+admin_sessions = {}
+
+class Histogram:
+    """Durations counted into LATENCY_BUCKETS, plus their sum"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+def bucket_quantile(counts, fraction):
+    """Upper bound of the bucket a quantile falls in (the last bound for the overflow bucket)"""
+    rank = fraction * sum(counts)
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + (LATENCY_BUCKETS[-1],), counts):
+        seen += count
+        if count and seen >= rank:
+            return bound
+    return 0
+
+class Metrics:
+    """Counters and latency histograms, named and labelled as Prometheus series.
+
+    A series is keyed by its family name and a tuple of (label, value)
+    pairs. Callers on hot paths fetch their Histogram once and keep it, so
+    recording a duration is a bisect and one uncontended lock.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def histogram(self, family, **labels):
+        key = (family, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            return histogram
+
+    def add(self, family, amount=1, **labels):
+        key = (family, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def request(self, method, route, status, seconds, bytes_in, bytes_out):
+        self.histogram("rycord_request_seconds", method=method, route=route).observe(seconds)
+        labels = (("method", method), ("route", route))
+        with self.lock:
+            for family, labels, amount in (
+                ("rycord_requests_total", labels + (("status", str(status)),), 1),
+                ("rycord_request_bytes_total", labels + (("direction", "in"),), bytes_in),
+                ("rycord_request_bytes_total", labels + (("direction", "out"),), bytes_out)
+            ):
+                self.counters[(family, labels)] = self.counters.get((family, labels), 0) + amount
+
+    def series(self):
+        """(counters, histograms) as lists of (family, labels, value) sorted by family"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        return ([(family, dict(labels), value) for (family, labels), value in counters],
+                [(family, dict(labels), histogram.snapshot()) for (family, labels), histogram in histograms])
+
+metrics = Metrics()
+
+class TimedLock:
+    """A Lock that records how long it was waited for and held"""
+
+    def __init__(self, name):
+        self.lock = Lock()
+        self.wait_time = metrics.histogram("rycord_lock_wait_seconds", lock=name, mode="exclusive")
+        self.hold_time = metrics.histogram("rycord_lock_hold_seconds", lock=name, mode="exclusive")
+        self.acquired = 0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.wait_time.observe(self.acquired - started)
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.hold_time.observe(held)
+
+class SamplingProfiler:
+    """Samples every thread's stack each PROFILE_INTERVAL while switched on.
+
+    Stacks are kept in the collapsed "outer;inner;leaf count" form that
+    flamegraph.pl reads, up to PROFILE_MAX_STACKS distinct ones; samples
+    of any further stacks are counted under "[other]". Threads parked
+    waiting for work show up too, so look at the busy stacks.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.thread = None
+        self.stop_event = None
+        self.interval = PROFILE_INTERVAL
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+
+    def start(self, interval=PROFILE_INTERVAL):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.interval = interval
+            self.stacks = {}
+            self.samples = 0
+            self.started = time.time()
+            self.stop_event = Event()
+            self.thread = Thread(target=self.run, args=(self.stop_event,), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return
+            self.stop_event.set()
+        thread.join()
+
+    def run(self, stop):
+        me = get_ident()
+        while not stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                        frame = frame.f_back
+                    key = ";".join(reversed(stack))
+                    if key not in self.stacks and len(self.stacks) >= PROFILE_MAX_STACKS:
+                        key = "[other]"
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                    self.samples += 1
+
+    def collapsed(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def summary(self, top=20):
+        """Whether it is running, and the functions most often on top of a stack"""
+        leaves = {}
+        with self.lock:
+            for stack, count in self.stacks.items():
+                leaf = stack.rpartition(";")[2]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            summary = {"running": self.thread is not None, "started": self.started,
+                       "interval": self.interval, "samples": self.samples}
+        summary["top"] = sorted(leaves.items(), key=lambda item: -item[1])[:top]
+        return summary
+
+profiler = SamplingProfiler()
+
+class RWLock:
+    """Any number of readers or a single writer.
+
+    A waiting writer holds off new readers so a steady stream of reads
+    cannot starve it. Not reentrant: never take it twice in one thread.
+    Named locks record wait and hold times under their name.
+    """
+
+    def __init__(self, name=None):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.timings = None
+        if name is not None:
+            self.timings = {
+                mode: (metrics.histogram("rycord_lock_wait_seconds", lock=name, mode=mode),
+                       metrics.histogram("rycord_lock_hold_seconds", lock=name, mode=mode))
+                for mode in ("read", "write")
+            }
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        started = time.perf_counter()
+        self.acquire_read()
+        acquired = time.perf_counter()
+        try:
+            yield
+        finally:
+            released = time.perf_counter()
+            self.release_read()
+            if self.timings is not None:
+                self.record("read", acquired - started, released - acquired)
+
+    @contextmanager
+    def write(self):
+        started = time.perf_counter()
+        self.acquire_write()
+        acquired = time.perf_counter()
+        try:
+            yield
+        finally:
+            released = time.perf_counter()
+            self.release_write()
+            if self.timings is not None:
+                self.record("write", acquired - started, released - acquired)
+
+    def record(self, mode, waited, held):
+        wait_time, hold_time = self.timings[mode]
+        wait_time.observe(waited)
+        hold_time.observe(held)
+
+# Lock order: channels_lock, then a channel's own "lock". The users and
+# moderation locks and the session store's lock are never held together,
+# and none of them is held across disk I/O.
+channels_lock = RWLock("channels")
+users_lock = TimedLock("users")
+moderation_lock = RWLock("moderation")
+
+def id_hash(message_id):
+    """A 64-bit hash of a message id that, unlike hash(), is the same in every process"""
+    return int.from_bytes(hashlib.blake2b(str(message_id).encode(), digest_size=8).digest(), 'little', signed=True)
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+class Message:
+    """A chat message in compact form.
+
+    Slots instead of a dict, interned usernames, colors and types (a handful
+    of values repeated on every message) and a float timestamp. Messages are
+    never changed once stored, so they can be shared between threads.
+    """
+
+    __slots__ = ("id", "seq", "username", "text", "timestamp", "color", "type",
+                 "file_id", "file_name", "file_size")
+
+    def __init__(self, id, username, text, timestamp, color, type, seq=0,
+                 file_id=None, file_name=None, file_size=None):
+        self.id = id
+        self.seq = seq
+        self.username = intern(username)
+        self.text = text
+        self.timestamp = timestamp
+        self.color = intern(color)
+        self.type = intern(type)
+        self.file_id = file_id
+        self.file_name = file_name
+        self.file_size = file_size
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("id"), data.get("username"), data.get("text", ""),
+                   parse_timestamp(data.get("timestamp")), data.get("color"), data.get("type", "text"),
+                   data.get("seq") or 0, data.get("fileId"), data.get("fileName"), data.get("fileSize"))
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "username": self.username,
+            "text": self.text,
+            "timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
+            "color": self.color,
+            "type": self.type
+        }
+        if self.file_id is not None:
+            data["fileId"] = self.file_id
+            data["fileName"] = self.file_name
+            data["fileSize"] = self.file_size
+        data["seq"] = self.seq
+        return data
+
+class MessageLog:
+    """Append-only, segmented message storage with one log directory per channel.
+
+    Each segment is a file of JSON lines: "add" records carry a message,
+    "del" records are tombstones for a message id. A segment starting with a
+    "base" record holds a compacted copy of the channel and supersedes every
+    segment before it, which is what makes compaction safe to interrupt.
+    Every record carries the channel sequence number it was written at.
+
+    Every LOG_CHECKPOINT_EVERY-th add record is remembered as a checkpoint
+    (seq, segment, offset), so read() can fetch history that is no longer
+    kept in memory without scanning the whole log.
+
+    A snapshot file saves what load() works out for each channel (the live
+    seqs and id hashes, checkpoints and counters) together with the log
+    position it was taken at. It starts with a JSON header whose table gives
+    each channel's offset into the binary arrays that follow, so load()
+    reads just its own channel's arrays and replays only the records written
+    after them. A snapshot that no longer matches the log (a compaction
+    replaced its segments, the channel was deleted and created again, or a
+    crash cut the log short) is ignored and the channel is replayed in full.
+    origin() is what tells a recreated channel's log from the old one.
+
+    A follower (a worker in multi-process mode) never writes: another
+    process appends and compacts, and the follower scans whatever has been
+    added since it last looked before it reads, to keep its checkpoints and
+    written_seq() current.
+    """
+
+    def __init__(self, root, snapshot_path=None):
+        self.root = root
+        self.snapshot_path = snapshot_path
+        self.follower = False
+        self.lock = Lock()
+        self.logs = {}
+        self.snapshot_lock = Lock()
+        self.snapshot = {}
+
+    def _channel_dir(self, channel):
+        return os.path.join(self.root, quote(channel, safe='').replace('.', '%2E'))
+
+    def _segments(self, channel):
+        directory = self._channel_dir(channel)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+
+    def _segment_path(self, channel, number):
+        return os.path.join(self._channel_dir(channel), f"{number:08d}.log")
+
+    def _state(self, channel):
+        with self.lock:
+            state = self.logs.get(channel)
+            if state is None:
+                segments = self._segments(channel)
+                state = {
+                    "lock": Lock(),
+                    "pending": deque(),
+                    "segment": segments[-1] if segments else 1,
+                    "file": None,
+                    "size": 0,
+                    "live": 0,
+                    "dead": 0,
+                    "adds": 0,
+                    "checkpoints": [],
+                    "scanned": None,
+                    "written_seq": 0,
+                    "unsynced": False,
+                    "dropped": False
+                }
+                self.logs[channel] = state
+            return state
+
+    def _write(self, channel, state, record):
+        if state["file"] is None:
+            os.makedirs(self._channel_dir(channel), exist_ok=True)
+            state["file"] = open(self._segment_path(channel, state["segment"]), 'ab')
+            state["size"] = state["file"].tell()
+        elif state["size"] >= SEGMENT_MAX_BYTES:
+            state["file"].flush()
+            os.fsync(state["file"].fileno())
+            state["file"].close()
+            state["segment"] += 1
+            state["file"] = open(self._segment_path(channel, state["segment"]), 'ab')
+            state["size"] = 0
+        line = (json.dumps(record, separators=(',', ':')) + "\n").encode()
+        if record["op"] == "add":
+            if state["adds"] % LOG_CHECKPOINT_EVERY == 0:
+                state["checkpoints"].append((record["msg"]["seq"], state["segment"], state["size"]))
+            state["adds"] += 1
+        state["file"].write(line)
+        state["size"] += len(line)
+        state["written_seq"] = record.get("seq") or record["msg"]["seq"]
+        if record["op"] == "add":
+            state["live"] += 1
+        else:
+            state["live"] -= 1
+            state["dead"] += 2
+
+    def has_channel(self, channel):
+        return bool(self._segments(channel))
+
+    def origin(self, channel):
+        """A hash of the record that started the log, or None if it has none yet.
+
+        Compaction carries it over in the base record, so it stays the same
+        for the life of the log and differs for a log started after the
+        channel was deleted and created again under the same name.
+        """
+        segments = self._segments(channel)
+        if not segments:
+            return None
+        try:
+            with open(self._segment_path(channel, segments[0]), 'rb') as f:
+                line = f.readline()
+        except OSError:
+            return None
+        if not line.endswith(b"\n"):
+            return None
+        if line.startswith(b'{"op":"base"'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return None
+            if record.get("origin") is not None:
+                return record["origin"]
+        return id_hash(line.decode('utf-8', 'replace'))
+
+    def load(self, channel):
+        """Replay a channel's segments, repairing anything a crash left behind.
+
+        Returns the sequence numbers of the live messages with a hash of
+        each one's id, as two parallel arrays, and the channel's sequence
+        number. Messages themselves stay on disk; fetch them with read().
+        """
+        directory = self._channel_dir(channel)
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(directory, name))
+
+        segments = self._segments(channel)
+        start = 0
+        for i, number in enumerate(segments):
+            with open(self._segment_path(channel, number), 'rb') as f:
+                if f.readline().startswith(b'{"op":"base"'):
+                    start = i
+        for number in segments[:start]:
+            os.remove(self._segment_path(channel, number))
+        segments = segments[start:]
+
+        seqs = array('q')
+        ids = array('q')
+        removed = set()
+        checkpoints = []
+        dead = adds = seq = 0
+        scanned = None
+        resume_segment, resume_offset = 0, 0
+        snapshot = self._read_snapshot(channel, segments)
+        if snapshot is not None:
+            entry, seqs, ids, checkpoints = snapshot
+            dead, adds, seq = entry["dead"], entry["adds"], entry["seq"]
+            resume_segment, resume_offset = entry["segment"], entry["position"]
+        for number in segments:
+            if number < resume_segment:
+                continue
+            path = self._segment_path(channel, number)
+            good = resume_offset if number == resume_segment else 0
+            with open(path, 'rb') as f:
+                f.seek(good)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        if not line.endswith(b"\n"):
+                            break
+                        print(f"Skipping corrupt record in {path}")
+                        good += len(line)
+                        continue
+                    offset = good
+                    good += len(line)
+                    op = record.get("op")
+                    if op == "base":
+                        seq = max(seq, record.get("seq", 0))
+                    elif op == "add":
+                        msg = record["msg"]
+                        msg_seq = msg.get("seq") or seq + 1
+                        seq = max(seq, msg_seq)
+                        if adds % LOG_CHECKPOINT_EVERY == 0:
+                            checkpoints.append((msg_seq, number, offset))
+                        adds += 1
+                        seqs.append(msg_seq)
+                        ids.append(id_hash(msg.get("id")))
+                    elif op == "del":
+                        seq = max(seq, record.get("seq") or seq + 1)
+                        dead += 1
+                        position = self._deleted_position(seqs, ids, removed, record)
+                        if position is not None:
+                            removed.add(position)
+                            dead += 1
+            if good < os.path.getsize(path):
+                print(f"Truncating partial record at end of {path}")
+                with open(path, 'r+b') as f:
+                    f.truncate(good)
+            scanned = (number, good)
+
+        if removed:
+            seqs = array('q', (s for i, s in enumerate(seqs) if i not in removed))
+            ids = array('q', (h for i, h in enumerate(ids) if i not in removed))
+        state = self._state(channel)
+        with state["lock"]:
+            state["live"] = len(seqs)
+            state["dead"] = dead
+            state["adds"] = adds
+            state["checkpoints"] = checkpoints
+            state["scanned"] = scanned
+            state["written_seq"] = seq
+        return seqs, ids, seq
+
+    def _follow(self, channel, state):
+        """Pick up the checkpoints of records another process has written since the last look"""
+        segments = self._segments(channel)
+        if state["scanned"] is None or state["scanned"][0] not in segments:
+            state["checkpoints"], state["adds"] = [], 0
+            state["scanned"] = (segments[0], 0) if segments else None
+        if state["scanned"] is None:
+            return
+        segment, offset = state["scanned"]
+        seq = state["written_seq"]
+        for number in segments:
+            if number < segment:
+                continue
+            good = offset if number == segment else 0
+            try:
+                f = open(self._segment_path(channel, number), 'rb')
+            except FileNotFoundError:
+                # Compacted away under us; the next look starts from the base
+                state["scanned"] = None
+                return
+            with f:
+                f.seek(good)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    position = good
+                    good += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    op = record.get("op")
+                    if op == "base":
+                        state["checkpoints"], state["adds"] = [], 0
+                        seq = max(seq, record.get("seq", 0))
+                    elif op == "add":
+                        msg_seq = record["msg"].get("seq") or seq + 1
+                        seq = max(seq, msg_seq)
+                        if state["adds"] % LOG_CHECKPOINT_EVERY == 0:
+                            state["checkpoints"].append((msg_seq, number, position))
+                        state["adds"] += 1
+                    elif op == "del":
+                        seq = max(seq, record.get("seq") or seq + 1)
+            state["scanned"] = (number, good)
+        state["written_seq"] = seq
+
+    def load_snapshot(self):
+        """Read the snapshot's offset table; load() reads the arrays it points at"""
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                header = json.loads(f.readline())
+                start = f.tell()
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Error loading snapshot: {e}")
+            return
+        if header.get("version") != 1 or header.get("byteorder") != sys.byteorder:
+            return
+        with self.snapshot_lock:
+            self.snapshot = {name: dict(entry, offset=entry["offset"] + start)
+                             for name, entry in header["channels"].items()}
+
+    def _read_snapshot(self, channel, segments):
+        """(entry, seqs, ids, checkpoints) from the snapshot, or None if it doesn't match the log"""
+        with self.snapshot_lock:
+            entry = self.snapshot.get(channel)
+            if entry is None or not segments or segments[0] != entry["base"] or entry["segment"] not in segments:
+                return None
+            if entry.get("origin") != self.origin(channel):
+                return None
+            if os.path.getsize(self._segment_path(channel, entry["segment"])) < entry["position"]:
+                return None
+            seqs, ids, checkpoints = array('q'), array('q'), array('q')
+            try:
+                with open(self.snapshot_path, 'rb') as f:
+                    f.seek(entry["offset"])
+                    seqs.fromfile(f, entry["count"])
+                    ids.fromfile(f, entry["count"])
+                    checkpoints.fromfile(f, 3 * entry["checkpoints"])
+            except (OSError, EOFError) as e:
+                print(f"Error reading snapshot for #{channel}: {e}")
+                return None
+        return entry, seqs, ids, [tuple(checkpoints[i:i + 3]) for i in range(0, len(checkpoints), 3)]
+
+    def mark(self, channel, rotate=False):
+        """Queue a marker behind every record queued so far.
+
+        Call with the channel locked against writers, so that what the
+        caller sees of the channel is exactly what the log holds up to the
+        marker. Writing out the queue reaches the marker without the channel
+        locked: it then notes where the log ends, and with rotate, moves
+        later appends past a segment number reserved for a compacted base.
+        """
+        marker = {"op": "mark", "rotate": rotate}
+        self._state(channel)["pending"].append(marker)
+        return marker
+
+    def _reach_mark(self, channel, state, marker):
+        if state["file"]:
+            state["file"].flush()
+        if marker["rotate"]:
+            if state["file"]:
+                if state["unsynced"]:
+                    os.fsync(state["file"].fileno())
+                    state["unsynced"] = False
+                state["file"].close()
+                state["file"] = None
+            marker["base"] = state["segment"] + 1
+            state["segment"] = marker["base"] + 1
+            return
+        segments = self._segments(channel)
+        if segments:
+            marker["point"] = {
+                "base": segments[0],
+                "segment": segments[-1],
+                "position": os.path.getsize(self._segment_path(channel, segments[-1])),
+                "checkpoints": list(state["checkpoints"]),
+                "dead": state["dead"],
+                "adds": state["adds"]
+            }
+
+    def snapshot_point(self, channel, marker):
+        """Write out and sync the records before a marker from mark() and say where the log ended there.
+
+        Returns None for a channel with nothing on disk.
+        """
+        state = self._state(channel)
+        with state["lock"]:
+            self._drain(channel, state)
+            if state["file"] and state["unsynced"]:
+                os.fsync(state["file"].fileno())
+                state["unsynced"] = False
+        if marker.get("point") is None:
+            return None
+        return dict(marker["point"], origin=self.origin(channel))
+
+    def write_snapshot(self, sections):
+        """Replace the snapshot.
+
+        sections is a list of (channel, point, seq, seqs, ids), with point
+        from snapshot_point(), or (channel, None, ...) to carry over the
+        channel's entry from the current snapshot unchanged.
+        """
+        header = {"version": 1, "byteorder": sys.byteorder, "channels": {}}
+        blobs = []
+        offset = 0
+        with self.snapshot_lock:
+            old = dict(self.snapshot)
+        for channel, point, seq, seqs, ids in sections:
+            if point is None:
+                entry = old.get(channel)
+                if entry is None:
+                    continue
+                try:
+                    with open(self.snapshot_path, 'rb') as f:
+                        f.seek(entry["offset"])
+                        blob = f.read(8 * (2 * entry["count"] + 3 * entry["checkpoints"]))
+                except OSError:
+                    continue
+                entry = dict(entry)
+            else:
+                checkpoints = array('q', (value for checkpoint in point["checkpoints"] for value in checkpoint))
+                blob = seqs.tobytes() + ids.tobytes() + checkpoints.tobytes()
+                entry = dict(point, checkpoints=len(point["checkpoints"]), seq=seq, count=len(seqs))
+            entry["offset"] = offset
+            header["channels"][channel] = entry
+            blobs.append(blob)
+            offset += len(blob)
+
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header, separators=(',', ':')).encode() + b"\n")
+            start = f.tell()
+            for blob in blobs:
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.snapshot_lock:
+            os.replace(tmp_path, self.snapshot_path)
+            self.snapshot = {name: dict(entry, offset=entry["offset"] + start)
+                             for name, entry in header["channels"].items()}
+
+    def _deleted_position(self, seqs, ids, removed, record):
+        """Which add record a tombstone deletes, by the seq it names or else by id"""
+        if record.get("of") is not None:
+            position = bisect_left(seqs, record["of"])
+            if position < len(seqs) and seqs[position] == record["of"] and position not in removed:
+                return position
+            return None
+        # Tombstones written before "of" existed: the oldest live message with that id
+        key = id_hash(record.get("id"))
+        position = -1
+        while True:
+            try:
+                position = ids.index(key, position + 1)
+            except ValueError:
+                return None
+            if position not in removed:
+                return position
+
+    def read(self, channel, first, last):
+        """Messages added with a sequence number from first to last, in order.
+
+        Deleted messages may be included; callers know which seqs are live.
+        """
+        state = self._state(channel)
+        with state["lock"]:
+            if self.follower:
+                self._follow(channel, state)
+            checkpoints = state["checkpoints"]
+            i = bisect_right(checkpoints, first, key=lambda checkpoint: checkpoint[0]) - 1
+            segment, offset = checkpoints[i][1:] if i >= 0 else (0, 0)
+            seq = checkpoints[i][0] - 1 if i >= 0 else 0
+            found = []
+            for number in self._segments(channel):
+                if number < segment:
+                    continue
+                try:
+                    f = open(self._segment_path(channel, number), 'rb')
+                except FileNotFoundError:
+                    # A follower raced a compaction; its base comes later in the listing
+                    continue
+                with f:
+                    if number == segment:
+                        f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        op = record.get("op")
+                        if op == "base":
+                            # Supersedes what came before; only seen while a compaction lands
+                            found = []
+                            seq = max(seq, record.get("seq", 0))
+                        elif op == "del":
+                            seq = max(seq, record.get("seq") or seq + 1)
+                        elif op == "add":
+                            msg_seq = record["msg"].get("seq") or seq + 1
+                            seq = max(seq, msg_seq)
+                            if msg_seq > last:
+                                return found
+                            if msg_seq >= first:
+                                message = Message.from_dict(record["msg"])
+                                message.seq = msg_seq
+                                found.append(message)
+            return found
+
+    def written_seq(self, channel):
+        """Highest sequence number already handed to the operating system"""
+        state = self._state(channel)
+        if self.follower:
+            with state["lock"]:
+                self._follow(channel, state)
+        return state["written_seq"]
+
+    def append(self, channel, message):
+        """Queue an add record; it reaches disk on the next sync.
+
+        Records must be queued in sequence order, so call this while holding
+        the channel's write lock.
+        """
+        self._state(channel)["pending"].append({"op": "add", "msg": message.to_dict()})
+
+    def delete(self, channel, message, seq):
+        self._state(channel)["pending"].append({"op": "del", "id": message.id, "seq": seq, "of": message.seq})
+
+    def _drain(self, channel, state):
+        if state["dropped"]:
+            state["pending"].clear()
+            return
+        pending = state["pending"]
+        if not pending:
+            return
+        while pending:
+            record = pending.popleft()
+            if record["op"] == "mark":
+                self._reach_mark(channel, state, record)
+            else:
+                self._write(channel, state, record)
+                state["unsynced"] = True
+        if state["file"]:
+            state["file"].flush()
+
+    def drop(self, channel):
+        state = self._state(channel)
+        with state["lock"]:
+            state["dropped"] = True
+            state["pending"].clear()
+            if state["file"]:
+                state["file"].close()
+                state["file"] = None
+            shutil.rmtree(self._channel_dir(channel), ignore_errors=True)
+        with self.lock:
+            if self.logs.get(channel) is state:
+                del self.logs[channel]
+        with self.snapshot_lock:
+            self.snapshot.pop(channel, None)
+
+    def needs_compaction(self, channel):
+        state = self._state(channel)
+        with state["lock"]:
+            total = state["live"] + state["dead"]
+            if state["dead"] and state["dead"] >= total * COMPACT_GARBAGE_RATIO:
+                return True
+            return len(self._segments(channel)) > MAX_SEGMENTS
+
+    def begin_compaction(self, channel):
+        """Queue the rotation that reserves a segment number for the compacted base.
+
+        Must be called while the caller holds the lock guarding the message
+        list it is about to snapshot, so no append can slip in between.
+        Records already queued describe changes the snapshot includes, so
+        they are written to the old segments first. Pass what this returns
+        to write_base().
+        """
+        return self.mark(channel, rotate=True)
+
+    def write_base(self, channel, marker, messages, seq=0):
+        """Write a compacted base segment and remove the segments it replaces.
+
+        messages is an iterable of message dicts in sequence order.
+        """
+        state = self._state(channel)
+        with state["lock"]:
+            self._drain(channel, state)
+        base = marker.get("base")
+        if base is None:
+            return
+        os.makedirs(self._channel_dir(channel), exist_ok=True)
+        path = self._segment_path(channel, base)
+        tmp_path = path + ".tmp"
+        checkpoints = []
+        count = 0
+        origin = self.origin(channel)
+        with open(tmp_path, 'wb') as f:
+            if origin is None:
+                f.write(f'{{"op":"base","seq":{seq}}}\n'.encode())
+            else:
+                f.write(f'{{"op":"base","seq":{seq},"origin":{origin}}}\n'.encode())
+            for msg in messages:
+                if count % LOG_CHECKPOINT_EVERY == 0 and msg.get("seq"):
+                    checkpoints.append((msg["seq"], base, f.tell()))
+                f.write((json.dumps({"op": "add", "msg": msg}, separators=(',', ':')) + "\n").encode())
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        state = self._state(channel)
+        with state["lock"]:
+            # Swapped in under the lock so read() never sees the base and
+            # the segments it replaces at once
+            os.replace(tmp_path, path)
+            for number in self._segments(channel):
+                if number < base:
+                    os.remove(self._segment_path(channel, number))
+            state["checkpoints"] = checkpoints + [c for c in state["checkpoints"] if c[1] > base]
+            state["live"] = count
+            state["dead"] = 0
+
+    def sync(self):
+        """Write out every queued record and fsync the segments that changed"""
+        with self.lock:
+            states = list(self.logs.items())
+        for channel, state in states:
+            with state["lock"]:
+                self._drain(channel, state)
+                if state["unsynced"] and state["file"]:
+                    os.fsync(state["file"].fileno())
+                state["unsynced"] = False
+
+message_log = MessageLog(MESSAGES_DIR, SNAPSHOT_FILE)
+
+class ChangeNotifier:
+    """Per-topic change versions that waiting requests can block on.
+
+    Topics are "channel:<name>" for a channel's messages, "users" for
+    presence and "channels" for the channel list and moderation settings.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.versions = {}
+        self.waiters = {}
+
+    def snapshot(self, topics):
+        with self.lock:
+            return {topic: self.versions.get(topic, 0) for topic in topics}
+
+    def notify(self, topic):
+        with self.lock:
+            self.versions[topic] = self.versions.get(topic, 0) + 1
+            for event in self.waiters.pop(topic, ()):
+                event.set()
+
+    def wait(self, known, timeout):
+        """Block until a topic moves past its version in known, or timeout"""
+        event = Event()
+        with self.lock:
+            if any(self.versions.get(topic, 0) != version for topic, version in known.items()):
+                return True
+            for topic in known:
+                self.waiters.setdefault(topic, set()).add(event)
+        changed = event.wait(timeout)
+        with self.lock:
+            for topic in known:
+                waiters = self.waiters.get(topic)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self.waiters[topic]
+        return changed
+
+notifier = ChangeNotifier()
+
+channel_generations = count(1)
+
+def new_channel(name, loaded=True):
+    """A channel's in-memory history.
+
+    "messages" holds the newest messages in sequence order, with None left
+    in the slot of a deleted message so positions stay stable; "seqs"
+    mirrors it with each slot's sequence number for binary search, and
+    "index" maps message id to slot. Slots are compacted once more than half
+    are holes, which keeps deletes O(1) amortized.
+
+    Older messages stay on disk. For those only "cold_seqs" and "cold_ids"
+    (the seq and a hash of the id of each, in parallel arrays) are kept,
+    plus the seqs of any deleted since startup in "cold_deleted".
+    "cold_index" maps each live one's id hash to its seq (a tuple of seqs
+    in the rare case two ids share a hash), so finding one by id is O(1).
+
+    Everything is guarded by the channel's own "lock". Writers must check
+    "deleted" once they hold it, since the channel may have been removed
+    after they looked it up. "generation" tells a channel apart from an
+    earlier one of the same name, whose seqs started from the same place.
+
+    Channels listed at startup begin with "loaded" False and read their
+    history from the log the first time get_channel() hands them out.
+    """
+    return {
+        "name": name,
+        "generation": next(channel_generations),
+        "loaded": loaded,
+        "lock": RWLock("channel"),
+        "deleted": False,
+        "messages": [],
+        "seqs": [],
+        "index": {},
+        "holes": 0,
+        "cold_seqs": array('q'),
+        "cold_ids": array('q'),
+        "cold_deleted": set(),
+        "cold_index": {},
+        "seq": 0,
+        "deletions": deque(),
+        "deletions_floor": 0
+    }
+
+def rebuild_slots(channel_data, messages):
+    channel_data["messages"] = messages
+    channel_data["seqs"] = [msg.seq for msg in messages]
+    channel_data["index"] = {}
+    for position, msg in enumerate(messages):
+        channel_data["index"].setdefault(msg.id, position)
+    channel_data["holes"] = 0
+
+def load_history(channel_data, seqs, ids, seq):
+    """Load the newest HOT_HISTORY messages; leave the rest on disk"""
+    split = max(len(seqs) - HOT_HISTORY, 0)
+    hot = []
+    if split < len(seqs):
+        live = set(seqs[split:])
+        hot = [msg for msg in message_log.read(channel_data["name"], seqs[split], seqs[-1]) if msg.seq in live]
+    channel_data["cold_seqs"] = seqs[:split]
+    channel_data["cold_ids"] = ids[:split]
+    channel_data["cold_deleted"] = set()
+    cold_index = dict(zip(ids[:split], seqs[:split]))
+    if len(cold_index) < split:
+        cold_index = {}
+        for key, cold_seq in zip(ids[:split], seqs[:split]):
+            index_cold(cold_index, key, cold_seq)
+    channel_data["cold_index"] = cold_index
+    rebuild_slots(channel_data, hot)
+    channel_data["seq"] = seq
+    channel_data["deletions_floor"] = seq
+
+def evict_cold(channel_data):
+    """Drop the oldest resident messages from memory once they are on disk"""
+    seqs = channel_data["seqs"]
+    count = min(len(seqs) - HOT_HISTORY, bisect_right(seqs, message_log.written_seq(channel_data["name"])))
+    if count <= 0:
+        return
+    for msg in channel_data["messages"][:count]:
+        if msg is not None:
+            key = id_hash(msg.id)
+            channel_data["cold_seqs"].append(msg.seq)
+            channel_data["cold_ids"].append(key)
+            index_cold(channel_data["cold_index"], key, msg.seq)
+    rebuild_slots(channel_data, [msg for msg in channel_data["messages"][count:] if msg is not None])
+
+def get_channel(name, load=True):
+    """A channel's history, or None; lock the channel before touching it.
+
+    Loads the channel's history first unless load is False, in which case
+    check "loaded" before relying on it.
+    """
+    with channels_lock.read():
+        channel_data = channels.get(name)
+    if load and channel_data is not None and not channel_data["loaded"]:
+        ensure_loaded(channel_data)
+    return channel_data
+
+def ensure_loaded(channel_data):
+    with channel_data["lock"].write():
+        if channel_data["loaded"]:
+            return
+        try:
+            load_history(channel_data, *message_log.load(channel_data["name"]))
+        except Exception as e:
+            print(f"Error loading messages for #{channel_data['name']}: {e}")
+        channel_data["loaded"] = True
+
+def channel_names():
+    with channels_lock.read():
+        return list(channels.keys())
+
+def live_messages(channel_data):
+    """The messages held in memory"""
+    return [msg for msg in channel_data["messages"] if msg is not None]
+
+def cold_page(channel_data, start, end, deleted=None):
+    """Read back the live messages between two positions of the cold arrays"""
+    if start >= end:
+        return []
+    cold_seqs = channel_data["cold_seqs"]
+    wanted = set(cold_seqs[start:end]) - (channel_data["cold_deleted"] if deleted is None else deleted)
+    return [
+        msg for msg in message_log.read(channel_data["name"], cold_seqs[start], cold_seqs[end - 1])
+        if msg.seq in wanted
+    ]
+
+def snapshot_history(channel_data):
+    """Pin down a channel's history under its lock, for iter_history() to read after"""
+    return len(channel_data["cold_seqs"]), set(channel_data["cold_deleted"]), live_messages(channel_data)
+
+def iter_history(channel_data, snapshot, chunk=1000, after=0):
+    """Every message in a snapshot after a seq, oldest first, reading cold ones from disk a chunk at a time"""
+    cold_count, deleted, hot = snapshot
+    first = bisect_right(channel_data["cold_seqs"], after, 0, cold_count)
+    for start in range(first, cold_count, chunk):
+        yield from cold_page(channel_data, start, min(start + chunk, cold_count), deleted)
+    for msg in hot:
+        if msg.seq > after:
+            yield msg
+
+def message_at(channel_data, seq):
+    """The live message with a given seq, or None"""
+    position = seq_position(channel_data, seq - 1)
+    if position < len(channel_data["seqs"]) and channel_data["seqs"][position] == seq:
+        return channel_data["messages"][position]
+    cold_seqs = channel_data["cold_seqs"]
+    position = bisect_left(cold_seqs, seq)
+    if position == len(cold_seqs) or cold_seqs[position] != seq or seq in channel_data["cold_deleted"]:
+        return None
+    found = message_log.read(channel_data["name"], seq, seq)
+    return found[0] if found and found[0].seq == seq else None
+
+def index_cold(cold_index, key, seq):
+    seqs = cold_index.get(key)
+    if seqs is None:
+        cold_index[key] = seq
+    else:
+        cold_index[key] = (seqs if isinstance(seqs, tuple) else (seqs,)) + (seq,)
+
+def unindex_cold(cold_index, key, seq):
+    seqs = cold_index.get(key)
+    if seqs == seq:
+        del cold_index[key]
+    elif isinstance(seqs, tuple):
+        rest = tuple(other for other in seqs if other != seq)
+        cold_index[key] = rest[0] if len(rest) == 1 else rest
+
+def find_cold(channel_data, message_id):
+    """Look up a message that is only on disk by id, or None"""
+    seqs = channel_data["cold_index"].get(id_hash(message_id))
+    if seqs is None:
+        return None
+    for seq in (seqs if isinstance(seqs, tuple) else (seqs,)):
+        for msg in message_log.read(channel_data["name"], seq, seq):
+            if msg.seq == seq and msg.id == message_id:
+                return msg
+    return None
+
+def get_message(channel_data, message_id):
+    position = channel_data["index"].get(message_id)
+    if position is not None:
+        return channel_data["messages"][position]
+    return find_cold(channel_data, message_id)
+
+def append_message(channel_data, message):
+    """Stamp a message with the channel's next sequence number and store it.
+
+    Returns False without storing anything if the id is already taken.
+    """
+    if message.id in channel_data["index"] or find_cold(channel_data, message.id):
+        return False
+    channel_data["seq"] += 1
+    message.seq = channel_data["seq"]
+    channel_data["index"][message.id] = len(channel_data["messages"])
+    channel_data["messages"].append(message)
+    channel_data["seqs"].append(message.seq)
+    if len(channel_data["messages"]) >= HOT_HISTORY + HOT_HISTORY // 4:
+        evict_cold(channel_data)
+    return True
+
+def remove_message(channel_data, message):
+    """Remove a message found with get_message() and remember the deletion so pollers can see it"""
+    position = channel_data["index"].get(message.id)
+    if position is not None and channel_data["messages"][position] is message:
+        del channel_data["index"][message.id]
+        channel_data["messages"][position] = None
+        channel_data["holes"] += 1
+    else:
+        channel_data["cold_deleted"].add(message.seq)
+        unindex_cold(channel_data["cold_index"], id_hash(message.id), message.seq)
+    channel_data["seq"] += 1
+    deletions = channel_data["deletions"]
+    deletions.append((channel_data["seq"], message.id))
+    if len(deletions) > MAX_TRACKED_DELETIONS:
+        channel_data["deletions_floor"] = deletions.popleft()[0]
+    
+    if channel_data["holes"] * 2 > len(channel_data["messages"]):
+        rebuild_slots(channel_data, live_messages(channel_data))
+    return channel_data["seq"]
+
+def seq_position(channel_data, seq):
+    """Slot of the first message with a sequence number above seq"""
+    return bisect_right(channel_data["seqs"], seq)
+
+def find_message_seq(channel_data, message_id):
+    message = get_message(channel_data, message_id)
+    return None if message is None else message.seq
+
+def messages_since(channel_data, since, limit):
+    """New messages and deletions after a cursor, oldest first"""
+    cold_seqs = channel_data["cold_seqs"]
+    cold_start = bisect_right(cold_seqs, since)
+    cold_end = min(cold_start + limit, len(cold_seqs))
+    page = cold_page(channel_data, cold_start, cold_end)
+    
+    messages = channel_data["messages"]
+    start = seq_position(channel_data, since)
+    end = min(start + limit - (cold_end - cold_start), len(messages))
+    page += [msg for msg in messages[start:end] if msg is not None]
+    has_more = cold_end < len(cold_seqs) or end < len(messages)
+    if not has_more:
+        cursor = channel_data["seq"]
+    elif end > start:
+        cursor = channel_data["seqs"][end - 1]
+    else:
+        cursor = cold_seqs[cold_end - 1]
+    deleted = [
+        message_id for seq, message_id in channel_data["deletions"]
+        if since < seq <= cursor
+    ]
+    return {
+        "messages": [msg.to_dict() for msg in page],
+        "deleted": deleted,
+        "seq": cursor,
+        "hasMore": has_more,
+        "reset": since < channel_data["deletions_floor"]
+    }
+
+def messages_before(channel_data, before, limit):
+    """The newest page of messages older than a cursor"""
+    messages = channel_data["messages"]
+    position = len(messages) if before is None else seq_position(channel_data, before - 1)
+    page = []
+    while position > 0 and len(page) < limit:
+        position -= 1
+        if messages[position] is not None:
+            page.append(messages[position])
+    page.reverse()
+    
+    has_older = position > 0
+    if not has_older:
+        cold_seqs = channel_data["cold_seqs"]
+        cold_end = len(cold_seqs) if before is None else bisect_left(cold_seqs, before)
+        cold_start = cold_end
+        wanted = limit - len(page)
+        while cold_start > 0 and wanted:
+            cold_start -= 1
+            if cold_seqs[cold_start] not in channel_data["cold_deleted"]:
+                wanted -= 1
+        page = cold_page(channel_data, cold_start, cold_end) + page
+        has_older = cold_start > 0
+    return {
+        "messages": [msg.to_dict() for msg in page],
+        "seq": channel_data["seq"],
+        "hasOlder": has_older
+    }
+
+def page_size(limit):
+    """A requested page size clamped to 1..MAX_PAGE_SIZE; None means the largest page"""
+    return MAX_PAGE_SIZE if limit is None else min(max(limit, 1), MAX_PAGE_SIZE)
+
+def query_messages(channel, since=None, before=None, limit=None, after_id=None):
+    """Resolve a /api/messages query against a channel"""
+    channel_data = get_channel(channel)
+    if channel_data is None:
+        return {"messages": [], "deleted": [], "seq": 0}
+    with channel_data["lock"].read():
+        return query_channel(channel_data, since, before, limit, after_id)
+
+def query_channel(channel_data, since, before, limit, after_id):
+    if after_id is not None:
+        since = find_message_seq(channel_data, after_id)
+        if since is None:
+            return {"messages": [], "deleted": [], "seq": channel_data["seq"], "reset": True}
+    
+    if since is not None:
+        return messages_since(channel_data, since, page_size(limit))
+    if limit is not None or before is not None:
+        return messages_before(channel_data, before, page_size(limit))
+    return {"messages": [msg.to_dict() for msg in live_messages(channel_data)], "seq": channel_data["seq"]}
+
+def has_changes(data):
+    return bool(data["messages"] or data.get("deleted") or data.get("reset"))
+
+def count_after(channel_data, since):
+    """How many live messages a channel holds after a cursor"""
+    cold_seqs = channel_data["cold_seqs"]
+    count = len(cold_seqs) - bisect_right(cold_seqs, since)
+    if count and channel_data["cold_deleted"]:
+        count -= sum(1 for seq in channel_data["cold_deleted"] if seq > since)
+    start = seq_position(channel_data, since)
+    return count + sum(1 for msg in channel_data["messages"][start:] if msg is not None)
+
+def sync_channel(channel_data, since, full):
+    """A channel's entry in a /api/sync response, or None if the cursor is current.
+
+    Every entry has the new cursor and the unread count since the old one;
+    with full, it also carries the messages and deletions, as for
+    /api/messages?since=. A client without a cursor is given the current
+    one, and a cursor past the end (the channel was removed and created
+    again) starts over with "reset".
+    """
+    seq = channel_data["seq"]
+    if since is None:
+        return {"seq": seq, "unread": 0}
+    if since == seq:
+        return None
+    reset = since > seq
+    if reset:
+        since = 0
+    update = {"seq": seq, "unread": count_after(channel_data, since)}
+    if full:
+        update.update(messages_since(channel_data, since, MAX_PAGE_SIZE))
+    if reset:
+        update["reset"] = True
+    return update
+
+def sync_response(username, cursors, focus, users_version, channels_version):
+    """(response, notifier versions it was built from) for /api/sync"""
+    known = notifier.snapshot(["channels", "users"])
+    names = channel_names()
+    with moderation_lock.read():
+        banned = username in banned_users
+        blocked = user_restrictions.get(username)
+        restricted = [name for name in names if name in blocked] if blocked else []
+    visible = [name for name in names if name not in restricted]
+    known.update(notifier.snapshot(["channel:" + name for name in visible]))
+    
+    response = {"status": "ok", "updates": {}}
+    if channels_version != known["channels"]:
+        response.update(channels=names, restricted=restricted, banned=banned, channelsVersion=known["channels"])
+    users_seen, users = sessions.online()
+    if users_version != users_seen:
+        response.update(users=users, usersVersion=users_seen)
+    for name in visible:
+        channel_data = get_channel(name)
+        if channel_data is None:
+            continue
+        cursor = cursors.get(name)
+        with channel_data["lock"].read():
+            update = sync_channel(channel_data, cursor if isinstance(cursor, int) else None, name == focus)
+        if update is not None:
+            response["updates"][name] = update
+    return response, known
+
+def tokenize(text):
+    return {token for token in re.findall(r"\w+", text.lower()) if len(token) <= 64}
+
+def message_terms(message):
+    # Older logs may hold non-string fields, which must not stop indexing
+    terms = tokenize(str(message.text or ""))
+    if message.file_name:
+        terms |= tokenize(str(message.file_name))
+    # Tokens never contain ":", so this can't collide with a word
+    terms.add("from:" + str(message.username).lower())
+    return terms
+
+class SearchIndex:
+    """Inverted index over every channel's messages.
+
+    Each indexed message gets a document number in the order it was
+    indexed, which is also newest-last across channels. Per channel, every
+    term maps to an ascending array of the documents containing it; the
+    author is indexed as a "from:<name>" term so a user filter is just one
+    more list to intersect. A query walks the shortest list backwards from
+    its cursor and checks the others by binary search, so a page costs
+    about the same however long the history is.
+
+    The index is saved to SEARCH_FILE from the maintenance loop. At startup
+    it is loaded and caught up from the message logs, or rebuilt from them
+    if the file is missing. Each channel's log origin is saved with it, so a
+    channel deleted and created again since is indexed afresh. Deletions the
+    saved copy missed are found when a hit turns out to be gone and are
+    dropped then.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.changed = False
+        self.reset()
+
+    def reset(self):
+        self.numbers = {}
+        self.channel_names = []
+        self.postings = []
+        self.channel_seqs = []
+        self.channel_docs = []
+        self.indexed = {}
+        self.origins = None
+        self.pending = set()
+        self.doc_channel = array('I')
+        self.doc_seq = array('Q')
+        self.alive = bytearray()
+
+    def _channel_number(self, channel):
+        number = self.numbers.get(channel)
+        if number is None:
+            number = self.numbers[channel] = len(self.channel_names)
+            self.channel_names.append(channel)
+            self.postings.append({})
+            self.channel_seqs.append(array('Q'))
+            self.channel_docs.append(array('I'))
+        return number
+
+    def hold(self, channels):
+        """Leave new messages in these channels to catch_up() until it has reached them"""
+        with self.lock:
+            self.pending = set(channels)
+
+    def add(self, channel, message):
+        """Index a new message; call in seq order per channel, with the channel locked"""
+        with self.lock:
+            if channel not in self.pending:
+                self._add(channel, message)
+
+    def _add(self, channel, message):
+        number = self._channel_number(channel)
+        doc = len(self.doc_seq)
+        self.doc_channel.append(number)
+        self.doc_seq.append(message.seq)
+        self.alive.append(1)
+        self.channel_seqs[number].append(message.seq)
+        self.channel_docs[number].append(doc)
+        postings = self.postings[number]
+        for term in message_terms(message):
+            if term not in postings:
+                postings[term] = array('I')
+            postings[term].append(doc)
+        self.indexed[channel] = message.seq
+        self.changed = True
+
+    def remove(self, channel, seq):
+        with self.lock:
+            number = self.numbers.get(channel)
+            if number is None:
+                return
+            seqs = self.channel_seqs[number]
+            position = bisect_left(seqs, seq)
+            if position < len(seqs) and seqs[position] == seq:
+                self.alive[self.channel_docs[number][position]] = 0
+                self.changed = True
+
+    def drop_channel(self, channel):
+        with self.lock:
+            self._drop(channel)
+
+    def _drop(self, channel):
+        number = self.numbers.pop(channel, None)
+        if number is None:
+            return
+        self.channel_names[number] = None
+        self.postings[number] = None
+        self.channel_seqs[number] = array('Q')
+        self.channel_docs[number] = array('I')
+        self.indexed.pop(channel, None)
+        self.pending.discard(channel)
+        self.changed = True
+
+    def search(self, terms, channels, before=None, limit=SEARCH_PAGE_SIZE):
+        """Up to limit (doc, channel, seq) hits containing every term, newest first"""
+        with self.lock:
+            walks = []
+            for channel in channels:
+                number = self.numbers.get(channel)
+                if number is None:
+                    continue
+                lists = [self.postings[number].get(term) for term in terms]
+                if all(lists):
+                    walks.append(self._walk(sorted(lists, key=len), before))
+            hits = []
+            for doc in merge(*walks, reverse=True):
+                hits.append((doc, self.channel_names[self.doc_channel[doc]], self.doc_seq[doc]))
+                if len(hits) == limit:
+                    break
+            return hits
+
+    def _walk(self, lists, before):
+        shortest, others = lists[0], lists[1:]
+        position = len(shortest) if before is None else bisect_left(shortest, before)
+        while position > 0:
+            position -= 1
+            doc = shortest[position]
+            if not self.alive[doc]:
+                continue
+            for other in others:
+                i = bisect_left(other, doc)
+                if i == len(other) or other[i] != doc:
+                    break
+            else:
+                yield doc
+
+    def catch_up(self, channel_names):
+        """Index what the logs hold beyond the saved index, then index sends as they happen.
+
+        The bulk is read from snapshots of the channels, oldest first across
+        channels, and indexed a chunk at a time so searches aren't held up
+        for long. The last few messages of each channel are indexed with it
+        locked, after which it leaves the pending set.
+        """
+        with self.lock:
+            for channel in list(self.numbers):
+                if channel not in channel_names:
+                    self._drop(channel)
+                elif self.origins is not None and self.origins.get(channel) != message_log.origin(channel):
+                    self._drop(channel)
+                    self.pending.add(channel)
+        histories = []
+        for name in channel_names:
+            channel_data = get_channel(name)
+            if channel_data is None:
+                continue
+            with channel_data["lock"].read():
+                snapshot = snapshot_history(channel_data)
+            histories.append(zip(repeat(name), iter_history(channel_data, snapshot, after=self.indexed.get(name, 0))))
+
+        merged = merge(*histories, key=lambda item: item[1].timestamp)
+        count = 0
+        while True:
+            chunk = list(islice(merged, 1000))
+            if not chunk:
+                break
+            with self.lock:
+                for name, message in chunk:
+                    if name in self.pending:
+                        self._add(name, message)
+            count += len(chunk)
+
+        for name in channel_names:
+            channel_data = get_channel(name)
+            if channel_data is None:
+                with self.lock:
+                    self.pending.discard(name)
+                continue
+            with channel_data["lock"].write():
+                with self.lock:
+                    if not channel_data["deleted"]:
+                        after = self.indexed.get(name, 0)
+                        for message in iter_history(channel_data, snapshot_history(channel_data), after=after):
+                            self._add(name, message)
+                            count += 1
+                    self.pending.discard(name)
+        return count
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            header = {
+                "version": 1,
+                "byteorder": sys.byteorder,
+                "channels": list(self.channel_names),
+                "indexed": dict(self.indexed),
+                "origins": {name: message_log.origin(name) for name in self.numbers},
+                "docs": len(self.doc_seq),
+                "postings": []
+            }
+            lists = []
+            for number, postings in enumerate(self.postings):
+                for term, docs in (postings or {}).items():
+                    header["postings"].append([number, term, len(docs)])
+                    lists.append(docs)
+            doc_channel = self.doc_channel[:]
+            doc_seq = self.doc_seq[:]
+            alive = bytes(self.alive)
+            self.changed = False
+        
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header, separators=(',', ':')).encode() + b"\n")
+            doc_channel.tofile(f)
+            doc_seq.tofile(f)
+            f.write(alive)
+            for docs, (_, _, length) in zip(lists, header["postings"]):
+                docs[:length].tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Read the saved index; False if there is none or it can't be used"""
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get("version") != 1 or header.get("byteorder") != sys.byteorder:
+                    return False
+                count = header["docs"]
+                self.reset()
+                self.doc_channel.fromfile(f, count)
+                self.doc_seq.fromfile(f, count)
+                self.alive = bytearray(f.read(count))
+                for name in header["channels"]:
+                    number = len(self.channel_names)
+                    self.channel_names.append(name)
+                    self.postings.append({} if name is not None else None)
+                    self.channel_seqs.append(array('Q'))
+                    self.channel_docs.append(array('I'))
+                    if name is not None:
+                        self.numbers[name] = number
+                for number, term, length in header["postings"]:
+                    docs = array('I')
+                    docs.fromfile(f, length)
+                    self.postings[number][term] = docs
+        except (OSError, ValueError, KeyError, EOFError) as e:
+            if os.path.exists(self.path):
+                print(f"Error loading search index: {e}")
+            self.reset()
+            return False
+        
+        for doc, number in enumerate(self.doc_channel):
+            if self.channel_names[number] is not None:
+                self.channel_seqs[number].append(self.doc_seq[doc])
+                self.channel_docs[number].append(doc)
+        self.indexed = header["indexed"]
+        self.origins = header.get("origins")
+        return True
+
+search_index = SearchIndex(SEARCH_FILE)
+
+class SessionStore:
+    """Login sessions with idle expiry, and who is online right now.
+
+    A session expires SESSION_TTL seconds after it was last seen. Expiry
+    times sit in a min-heap; seeing a session only updates its record, and
+    an out-of-date heap entry is pushed back with the new time when it
+    reaches the top. The store holds at most MAX_SESSIONS sessions and
+    MAX_SESSIONS_PER_USER per user, evicting the least recently seen.
+
+    Presence is keyed by username in the order users were last seen, so a
+    heartbeat moves one key to the end and users who went quiet are popped
+    off the front. A user with several tabs open is online once. Each
+    change to the online set bumps a version, and the list handed out is
+    rebuilt only when the version moves.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, max_per_user=MAX_SESSIONS_PER_USER):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self.lock = TimedLock("sessions")
+        self.sessions = {}
+        self.by_user = {}
+        self.expiry = []
+        self.presence = OrderedDict()
+        self.version = 0
+        self.snapshot = (0, [])
+
+    def create(self, username, color, session_id=None):
+        session_id = session_id or str(uuid.uuid4())
+        now = datetime.now().timestamp()
+        with self.lock:
+            self._expire(now)
+            user_sessions = self.by_user.setdefault(username, OrderedDict())
+            while len(user_sessions) >= self.max_per_user:
+                self._remove(next(iter(user_sessions)))
+            while len(self.sessions) >= self.max_sessions:
+                self._remove(self._least_recent()[1])
+            self.sessions[session_id] = {"username": username, "color": color, "last_seen": now}
+            user_sessions[session_id] = None
+            heappush(self.expiry, (now + self.ttl, session_id))
+            if len(self.expiry) > 2 * len(self.sessions) + 64:
+                self._rebuild_expiry()
+            self._seen(username, color, now)
+        return session_id
+
+    def get(self, session_id):
+        """The live session for an id, or None"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session and datetime.now().timestamp() - session["last_seen"] >= self.ttl:
+                self._remove(session_id)
+                return None
+            return session
+
+    def touch(self, session_id):
+        """Record a heartbeat: True if the user just came online, None for an unknown session"""
+        now = datetime.now().timestamp()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            session["last_seen"] = now
+            self.by_user[session["username"]].move_to_end(session_id)
+            return self._seen(session["username"], session["color"], now)
+
+    def online(self):
+        """(version, users) for everyone seen within PRESENCE_TIMEOUT"""
+        cutoff = datetime.now().timestamp() - PRESENCE_TIMEOUT
+        with self.lock:
+            while self.presence and next(iter(self.presence.values()))[0] < cutoff:
+                self.presence.popitem(last=False)
+                self.version += 1
+            if self.snapshot[0] != self.version:
+                users = [
+                    {"username": username, "color": color}
+                    for username, (_, color) in sorted(self.presence.items())
+                ]
+                self.snapshot = (self.version, users)
+            return self.snapshot
+
+    def expire(self):
+        with self.lock:
+            self._expire(datetime.now().timestamp())
+
+    def _seen(self, username, color, now):
+        came_online = username not in self.presence
+        self.presence[username] = (now, color)
+        self.presence.move_to_end(username)
+        if came_online:
+            self.version += 1
+        return came_online
+
+    def _least_recent(self):
+        """(expires, session_id) of the least recently seen session, or None"""
+        while self.expiry:
+            expires, session_id = self.expiry[0]
+            session = self.sessions.get(session_id)
+            if session is None:
+                heappop(self.expiry)
+            elif session["last_seen"] + self.ttl > expires:
+                heapreplace(self.expiry, (session["last_seen"] + self.ttl, session_id))
+            else:
+                return expires, session_id
+        return None
+
+    def _expire(self, now):
+        while True:
+            due = self._least_recent()
+            if due is None or due[0] > now:
+                return
+            self._remove(due[1])
+
+    def _remove(self, session_id):
+        username = self.sessions.pop(session_id)["username"]
+        user_sessions = self.by_user[username]
+        del user_sessions[session_id]
+        if not user_sessions:
+            del self.by_user[username]
+
+    def _rebuild_expiry(self):
+        # Removed sessions leave their heap entries behind; drop them in one go
+        self.expiry = [(s["last_seen"] + self.ttl, sid) for sid, s in self.sessions.items()]
+        heapify(self.expiry)
+
+sessions = SessionStore()
+
+def load_data():
+    """Load what the server needs before it can answer; finish_loading() does the rest.
+
+    Channels are listed but their history is read on first use, and the
+    search index is caught up and users.json read in the background.
+    """
+    global channels
+    
+    if os.path.exists(CHANNELS_FILE):
+        try:
+            with open(CHANNELS_FILE, 'r') as f:
+                channel_names = json.load(f)
+                for ch in channel_names:
+                    if ch not in channels:
+                        channels[ch] = new_channel(ch, loaded=False)
+        except Exception as e:
+            print(f"Error loading channels: {e}")
+    
+    if not channels:
+        channels = {
+            "general": new_channel("general", loaded=False),
+            "random": new_channel("random", loaded=False)
+        }
+        save_channels()
+    
+    if os.path.exists(MESSAGES_FILE):
+        import_legacy_messages()
+    
+    message_log.load_snapshot()
+    
+    if os.path.exists(BANNED_USERS_FILE):
+        try:
+            with open(BANNED_USERS_FILE, 'r') as f:
+                banned_users.update(json.load(f))
+        except Exception as e:
+            print(f"Error loading banned users: {e}")
+    
+    if os.path.exists(RESTRICTED_FILE):
+        try:
+            with open(RESTRICTED_FILE, 'r') as f:
+                for ch, users in json.load(f).items():
+                    for username in users:
+                        set_restricted(ch, username, True)
+        except Exception as e:
+            print(f"Error loading restricted channels: {e}")
+    
+    # Changes made since those files were written; fold them in and start a new journal
+    changes = moderation_journal.load()
+    for event in changes:
+        apply_event(event, owner=False)
+    if changes:
+        moderation_journal.compact()
+    
+    if os.path.exists(LIMITS_FILE):
+        try:
+            with open(LIMITS_FILE, 'r') as f:
+                admission.configure(json.load(f))
+        except Exception as e:
+            print(f"Error loading limits: {e}")
+    
+    if not search_index.load():
+        print("Building search index...")
+    search_index.hold(channels)
+
+def load_users():
+    try:
+        if os.path.exists(USERS_FILE):
+            with open(USERS_FILE, 'r') as f:
+                users = json.load(f)
+            with users_lock:
+                registered_users.update(users)
+    except Exception as e:
+        print(f"Error loading users: {e}")
+    finally:
+        users_loaded.set()
+
+def finish_loading():
+    """Read users and every channel's history while the server is already answering"""
+    started = time.monotonic()
+    load_users()
+    names = channel_names()
+    for name in names:
+        get_channel(name)
+    count = search_index.catch_up(names)
+    if count:
+        print(f"Indexed {count} messages for search")
+    print(f"Loaded {len(names)} channels in {time.monotonic() - started:.1f}s")
+    persistence.mark("search", "snapshot")
+
+def build_snapshot():
+    """Read every channel log in full and save the snapshot and search index"""
+    load_data()
+    finish_loading()
+    persistence.flush()
+    print(f"Wrote {SNAPSHOT_FILE} and {SEARCH_FILE}")
+
+def write_json(path, data):
+    """Replace a JSON file atomically so a crash leaves the old or new copy, never half of one"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def save_channels():
+    write_json(CHANNELS_FILE, channel_names())
+
+def import_legacy_messages():
+    """Move messages.json into the per-channel logs, then set it aside"""
+    try:
+        with open(MESSAGES_FILE, 'r') as f:
+            loaded_channels = json.load(f)
+    except Exception as e:
+        print(f"Error loading messages: {e}")
+        return
+    
+    for channel_name, channel_data in loaded_channels.items():
+        if channel_name in channels and not message_log.has_channel(channel_name):
+            messages = channel_data.get("messages", [])
+            for seq, msg in enumerate(messages, 1):
+                msg["seq"] = seq
+            marker = message_log.begin_compaction(channel_name)
+            message_log.write_base(channel_name, marker, messages, len(messages))
+    
+    os.replace(MESSAGES_FILE, MESSAGES_FILE + ".imported")
+    print(f"Imported {MESSAGES_FILE} into {MESSAGES_DIR}")
+
+def save_messages():
+    message_log.sync()
+
+def compact_messages():
+    """Compact every channel log that has accumulated enough garbage"""
+    for channel_name in channel_names():
+        if not message_log.needs_compaction(channel_name):
+            continue
+        channel_data = get_channel(channel_name)
+        if channel_data is None:
+            continue
+        # A read lock is enough: it keeps writers out while readers carry on
+        with channel_data["lock"].read():
+            if channel_data["deleted"]:
+                continue
+            snapshot = snapshot_history(channel_data)
+            seq = channel_data["seq"]
+            marker = message_log.begin_compaction(channel_name)
+        try:
+            message_log.write_base(channel_name, marker,
+                                   (msg.to_dict() for msg in iter_history(channel_data, snapshot)), seq)
+        except Exception as e:
+            print(f"Error compacting #{channel_name}: {e}")
+
+def maintenance_loop(owner=True):
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        if not owner:
+            sessions.expire()
+            continue
+        compact_messages()
+        expire_uploads()
+        sessions.expire()
+        blob_store.collect_garbage()
+        persistence.mark("search", "snapshot")
+
+uploads_lock = Lock()
+upload_locks = {}
+upload_hashers = {}
+
+def safe_file_id(file_id):
+    """Client-supplied ids become file names, so only allow a conservative alphabet"""
+    if isinstance(file_id, str) and 0 < len(file_id) <= 64 and all(c.isalnum() or c in "-_" for c in file_id):
+        return file_id
+    return uuid.uuid4().hex
+
+def posting_error(session_id, username, channel):
+    """Why a user may not post to a channel, or None if they may"""
+    if not session_id or sessions.get(session_id) is None:
+        return "Invalid session"
+    with moderation_lock.read():
+        if username in banned_users:
+            return "You are banned"
+        if username in restricted_channels.get(channel, ()):
+            return "You cannot access this channel"
+    return None
+
+def upload_error(session_id, upload):
+    """Why a session may not touch an upload, or None if it started it and may still post"""
+    session = sessions.get(session_id) if session_id else None
+    if session is not None and session["username"] != upload["username"]:
+        return "Unknown upload"
+    return posting_error(session_id, upload["username"], upload["channel"])
+
+def upload_paths(upload_id):
+    base = os.path.join(UPLOADS_DIR, upload_id)
+    return base + ".json", base + ".part"
+
+def upload_lock(upload_id):
+    """Only take this for an upload known to exist; forget_upload drops it again"""
+    with uploads_lock:
+        return upload_locks.setdefault(upload_id, Lock())
+
+def forget_upload(upload_id):
+    """Drop the lock and running hash of an upload that is finished or gone; returns the hash entry"""
+    with uploads_lock:
+        upload_locks.pop(upload_id, None)
+        return upload_hashers.pop(upload_id, None)
+
+def create_upload(username, channel, file_id, file_name, file_size, mime_type, msg_type, color):
+    """Start a resumable upload; the .part file grows as chunks arrive"""
+    upload = {
+        "uploadId": uuid.uuid4().hex,
+        "fileId": safe_file_id(file_id),
+        "username": username,
+        "channel": channel,
+        "fileName": file_name,
+        "fileSize": file_size,
+        "mimeType": mime_type,
+        "type": msg_type,
+        "color": color
+    }
+    state_path, part_path = upload_paths(upload["uploadId"])
+    open(part_path, 'wb').close()
+    with open(state_path, 'w') as f:
+        json.dump(upload, f)
+    upload["offset"] = 0
+    upload_hasher(upload["uploadId"], 0)
+    return upload
+
+def load_upload(upload_id):
+    if safe_file_id(upload_id) != upload_id:
+        return None
+    state_path, part_path = upload_paths(upload_id)
+    try:
+        with open(state_path, 'r') as f:
+            upload = json.load(f)
+        upload["offset"] = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return None
+    return upload
+
+def upload_hasher(upload_id, offset):
+    """The running sha256 of an upload if it has seen every byte before offset"""
+    with uploads_lock:
+        if offset == 0:
+            upload_hashers[upload_id] = [0, hashlib.sha256()]
+        entry = upload_hashers.get(upload_id)
+        return entry if entry and entry[0] == offset else None
+
+def finalize_upload(upload):
+    """Hand a completed upload to the blob store and post its message"""
+    state_path, part_path = upload_paths(upload["uploadId"])
+    entry = forget_upload(upload["uploadId"])
+    if entry and entry[0] == upload["fileSize"]:
+        digest = entry[1].hexdigest()
+    else:
+        digest = hash_file(part_path)
+    
+    post_file_message(upload["channel"], part_path, digest, upload["fileId"], upload["mimeType"],
+                      upload["username"], upload["color"], upload["type"], upload["fileName"], upload["fileSize"])
+    os.remove(state_path)
+
+def post_file_message(channel, path, digest, file_id, mime_type, username, color, msg_type, file_name, file_size):
+    """Move a fully written file into the blob store and post its message; raises OSError if it can't be stored"""
+    message = Message(file_id, username, "", time.time(), color or "#5865f2", msg_type or "file",
+                      file_id=file_id, file_name=file_name, file_size=file_size)
+    result = submit({"op": "file", "channel": channel, "msg": message, "path": path, "digest": digest,
+                     "metadata": {"mimeType": mime_type, "fileName": file_name}})
+    if result.get("error"):
+        raise OSError(result["error"])
+
+file_meta_cache = OrderedDict()
+file_meta_lock = Lock()
+
+def file_metadata(file_id):
+    """Parsed .meta sidecar for a file, cached until the sidecar changes"""
+    metadata_path = os.path.join(FILES_DIR, file_id + ".meta")
+    try:
+        mtime = os.stat(metadata_path).st_mtime_ns
+    except OSError:
+        return {}
+    
+    with file_meta_lock:
+        cached = file_meta_cache.get(file_id)
+        if cached and cached[0] == mtime:
+            file_meta_cache.move_to_end(file_id)
+            return cached[1]
+    
+    try:
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = {}
+    
+    with file_meta_lock:
+        file_meta_cache[file_id] = (mtime, metadata)
+        file_meta_cache.move_to_end(file_id)
+        while len(file_meta_cache) > FILE_META_CACHE_SIZE:
+            file_meta_cache.popitem(last=False)
+    return metadata
+
+def forget_file_metadata(file_id):
+    with file_meta_lock:
+        file_meta_cache.pop(file_id, None)
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_BUFFER_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class BlobStore:
+    """Content-addressed attachment storage with reference counts.
+
+    Every file id keeps its .meta sidecar in FILES_DIR, and the sidecar names
+    the sha256 of the content, so identical uploads share one blob under
+    blobs/. Reference counts are rebuilt from the sidecars at startup. A blob
+    that loses its last reference is removed by collect_garbage once
+    BLOB_GC_GRACE has passed. Files from before the blob store have no sha256
+    in their sidecar and are still served from FILES_DIR/<id>.
+    """
+
+    def __init__(self, files_dir, root):
+        self.files_dir = files_dir
+        self.root = root
+        self.lock = Lock()
+        self.refs = {}
+        self.orphans = {}
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def file_path(self, file_id, metadata):
+        digest = metadata.get("sha256")
+        return self.blob_path(digest) if digest else os.path.join(self.files_dir, file_id)
+
+    def read_metadata(self, file_id):
+        try:
+            with open(os.path.join(self.files_dir, file_id + ".meta"), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_metadata(self, file_id, metadata):
+        metadata_path = os.path.join(self.files_dir, file_id + ".meta")
+        with open(metadata_path + ".tmp", 'w') as f:
+            json.dump(metadata, f)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    def load(self):
+        """Rebuild reference counts from the sidecars and queue unreferenced blobs for collection"""
+        refs = {}
+        for name in os.listdir(self.files_dir):
+            if name.endswith('.meta'):
+                digest = self.read_metadata(name[:-5]).get("sha256")
+                if digest:
+                    refs[digest] = refs.get(digest, 0) + 1
+        
+        now = time.time()
+        with self.lock:
+            self.refs = refs
+            if os.path.isdir(self.root):
+                for prefix in os.listdir(self.root):
+                    for digest in os.listdir(os.path.join(self.root, prefix)):
+                        if digest not in refs:
+                            self.orphans[digest] = now
+
+    def add(self, source_path, digest, file_id, metadata, replace=True):
+        """Adopt a fully written file as the content of file_id; duplicates are discarded.
+
+        Without replace, a file id that already has content is left alone and
+        None is returned.
+        """
+        with self.lock:
+            if not replace and os.path.exists(os.path.join(self.files_dir, file_id + ".meta")):
+                os.remove(source_path)
+                return None
+            previous = self.read_metadata(file_id).get("sha256")
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.remove(source_path)
+                deduplicated = True
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(source_path, path)
+                deduplicated = False
+            
+            self.write_metadata(file_id, dict(metadata, sha256=digest, size=os.path.getsize(path)))
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            self.orphans.pop(digest, None)
+            if previous:
+                self._drop_ref(previous)
+        forget_file_metadata(file_id)
+        return deduplicated
 
-channels = {}
-registered_users = {}
-active_sessions = {}
-banned_users = []
-restricted_channels = {}
-admin_sessions = {}
-data_lock = Lock()
+    def release(self, file_id):
+        """Drop a file id's reference to its content"""
+        with self.lock:
+            digest = self.read_metadata(file_id).get("sha256")
+            for path in (os.path.join(self.files_dir, file_id + ".meta"),
+                         None if digest else os.path.join(self.files_dir, file_id)):
+                if path:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            if digest:
+                self._drop_ref(digest)
+        forget_file_metadata(file_id)
 
-def load_data():
-    """Load all data from disk"""
-    global channels, registered_users, banned_users, restricted_channels
+    def _drop_ref(self, digest):
+        count = self.refs.get(digest, 0) - 1
+        if count > 0:
+            self.refs[digest] = count
+        else:
+            self.refs.pop(digest, None)
+            self.orphans[digest] = time.time()
+
+    def collect_garbage(self, grace=BLOB_GC_GRACE):
+        """Remove blobs that have had no references for at least grace seconds"""
+        cutoff = time.time() - grace
+        freed = 0
+        with self.lock:
+            for digest, since in list(self.orphans.items()):
+                if since > cutoff:
+                    continue
+                del self.orphans[digest]
+                if digest in self.refs:
+                    continue
+                path = self.blob_path(digest)
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    pass
+        return freed
+
+blob_store = BlobStore(FILES_DIR, BLOBS_DIR)
+
+def migrate_files():
+    """Move files from the old one-file-per-id layout into the blob store"""
+    blob_store.load()
+    migrated = duplicates = saved = 0
+    for name in sorted(os.listdir(FILES_DIR)):
+        path = os.path.join(FILES_DIR, name)
+        if not os.path.isfile(path) or name.endswith('.meta') or name.endswith('.tmp'):
+            continue
+        metadata = blob_store.read_metadata(name)
+        if metadata.get("sha256"):
+            continue
+        size = os.path.getsize(path)
+        if blob_store.add(path, hash_file(path), name, metadata):
+            duplicates += 1
+            saved += size
+        migrated += 1
     
-    if os.path.exists(CHANNELS_FILE):
+    print(f"Migrated {migrated} files into {BLOBS_DIR}")
+    print(f"   - Duplicates removed: {duplicates}")
+    print(f"   - Disk space saved: {saved / (1024 * 1024):.1f} MB ({saved} bytes)")
+
+class StaticCache:
+    """In-memory copies of the HTML/CSS/JS assets with precompressed gzip variants.
+
+    Assets load on first request (or from preload) and reload when the file's
+    mtime changes. The mtime is checked at most once every STATIC_CHECK_INTERVAL
+    seconds.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+
+    def get(self, filename):
+        now = time.monotonic()
+        entry = self.entries.get(filename)
+        if entry and now - entry["checked"] < STATIC_CHECK_INTERVAL:
+            return entry
+        
         try:
-            with open(CHANNELS_FILE, 'r') as f:
-                channel_names = json.load(f)
-                for ch in channel_names:
-                    if ch not in channels:
-                        channels[ch] = {"name": ch, "messages": []}
-        except Exception as e:
-            print(f"Error loading channels: {e}")
-    
-    if not channels:
-        channels = {
-            "general": {"name": "general", "messages": []},
-            "random": {"name": "random", "messages": []}
+            stat = os.stat(filename)
+        except OSError:
+            with self.lock:
+                self.entries.pop(filename, None)
+            return None
+        if entry and entry["mtime"] == stat.st_mtime_ns:
+            entry["checked"] = now
+            return entry
+        
+        with open(filename, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        entry = {
+            "body": body,
+            "gzip": gzip.compress(body, 9) if len(body) >= GZIP_MIN_SIZE else None,
+            "etag": f'"{digest}"',
+            "gzip_etag": f'"{digest}-gz"',
+            "mtime": stat.st_mtime_ns,
+            "modified": stat.st_mtime,
+            "checked": now
         }
-        save_channels()
-    
-    if os.path.exists(MESSAGES_FILE):
-        try:
-            with open(MESSAGES_FILE, 'r') as f:
-                loaded_channels = json.load(f)
-                for channel_name, channel_data in loaded_channels.items():
-                    if channel_name in channels:
-                        channels[channel_name]["messages"] = channel_data.get("messages", [])
-        except Exception as e:
-            print(f"Error loading messages: {e}")
-    
-    if os.path.exists(USERS_FILE):
-        try:
-            with open(USERS_FILE, 'r') as f:
-                registered_users.update(json.load(f))
-        except Exception as e:
-            print(f"Error loading users: {e}")
-    
-    if os.path.exists(BANNED_USERS_FILE):
+        with self.lock:
+            self.entries[filename] = entry
+        return entry
+
+    def preload(self, filenames):
+        for filename in filenames:
+            self.get(filename)
+
+static_cache = StaticCache()
+
+def encode_response(data):
+    body = json.dumps(data, separators=(',', ':')).encode()
+    digest = hashlib.sha1(body).hexdigest()[:16]
+    return {
+        "body": body,
+        "gzip": gzip.compress(body, 6) if len(body) >= GZIP_MIN_SIZE else None,
+        "etag": f'"{digest}"',
+        "gzip_etag": f'"{digest}-gz"',
+        "size": len(body) * 2
+    }
+
+class ResponseCache:
+    """Encoded JSON for the read endpoints, reused until what it shows changes.
+
+    An entry is stored under a key naming the view (a channel and query,
+    the channel list, the online users) along with the version of the data
+    it was built from. Looking it up with any other version misses, so
+    writers never invalidate anything: bumping a channel's seq or the user
+    list's version is enough. The least recently used entries are dropped
+    once the bodies add up to RESPONSE_CACHE_BYTES.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["version"] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, data, **info):
+        """Encode data (outside any lock) and keep it; info is handed back with the entry"""
+        entry = encode_response(data)
+        entry["version"] = version
+        entry.update(info)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old["size"]
+            if entry["size"] <= self.max_bytes:
+                self.entries[key] = entry
+                self.size += entry["size"]
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1]["size"]
+        return entry
+
+response_cache = ResponseCache()
+
+def messages_response(channel, since=None, before=None, limit=None, after_id=None):
+    """A /api/messages response, encoded once per channel version"""
+    key = ("messages", channel, since, before, limit, after_id)
+    channel_data = get_channel(channel)
+    if channel_data is None:
+        version = None
+        entry = response_cache.get(key, version)
+        data = None if entry else {"messages": [], "deleted": [], "seq": 0}
+    else:
+        with channel_data["lock"].read():
+            version = (channel_data["generation"], channel_data["seq"])
+            entry = response_cache.get(key, version)
+            data = None if entry else query_channel(channel_data, since, before, limit, after_id)
+    if entry is None:
+        entry = response_cache.put(key, version, data, seq=data["seq"], changed=has_changes(data))
+    return entry
+
+def parse_range(header, size):
+    """(start, end) for a single "bytes=" range, False to ignore it, None if unsatisfiable"""
+    if not header.startswith('bytes=') or ',' in header:
+        return False
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = size - int(last)
+            end = size - 1
+    except ValueError:
+        return False
+    start = max(start, 0)
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def expire_uploads():
+    """Remove resumable uploads that have not been touched for UPLOAD_EXPIRY"""
+    cutoff = time.time() - UPLOAD_EXPIRY
+    for name in os.listdir(UPLOADS_DIR):
+        path = os.path.join(UPLOADS_DIR, name)
         try:
-            with open(BANNED_USERS_FILE, 'r') as f:
-                banned_users.extend(json.load(f))
-        except Exception as e:
-            print(f"Error loading banned users: {e}")
-    
-    if os.path.exists(RESTRICTED_FILE):
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                forget_upload(os.path.splitext(name)[0])
+        except OSError:
+            pass
+
+class AdmissionControl:
+    """Decides whether a request may go ahead before the server spends time on it.
+
+    Token buckets limit how often each session, user and client IP may use a
+    route class: a request needs a token from every bucket that applies to it
+    and is refused with 429 otherwise. Concurrent uploads and the request body
+    bytes held in memory at once are capped, and requests beyond a cap are
+    refused with 503. Loopback clients skip the IP buckets, since behind a
+    reverse proxy every client would share one. configure() swaps the limits
+    in while the server runs.
+    """
+
+    kinds = ("session", "user", "ip")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.buckets = OrderedDict()
+        self.uploads = 0
+        self.body_bytes = 0
+        self.configure({})
+
+    @classmethod
+    def validate(cls, settings):
+        """Complete settings from partial ones; raises ValueError if a limit is out of range"""
         try:
-            with open(RESTRICTED_FILE, 'r') as f:
-                restricted_channels.update(json.load(f))
-        except Exception as e:
-            print(f"Error loading restricted channels: {e}")
+            given = settings.get("rates") or {}
+            rates = {}
+            for route_class, defaults in RATE_LIMITS.items():
+                rates[route_class] = {}
+                for kind in cls.kinds:
+                    value = (given.get(route_class) or {}).get(kind, defaults[kind])
+                    if value is not None:
+                        rate, burst = float(value[0]), float(value[1])
+                        if not (0 < rate <= 1e6 and 1 <= burst <= 1e9):
+                            raise ValueError(f"Invalid {kind} limit for {route_class}")
+                        value = [rate, burst]
+                    rates[route_class][kind] = value
+            max_uploads = int(settings.get("max_uploads", MAX_CONCURRENT_UPLOADS))
+            max_body_bytes = int(settings.get("max_body_bytes", MAX_BODY_BYTES_IN_FLIGHT))
+        except (AttributeError, TypeError, IndexError) as e:
+            raise ValueError("Invalid limits") from e
+        if max_uploads < 1 or max_body_bytes < 1:
+            raise ValueError("Invalid limits")
+        return {"rates": rates, "max_uploads": max_uploads, "max_body_bytes": max_body_bytes}
 
-def save_channels():
-    with open(CHANNELS_FILE, 'w') as f:
-        json.dump(list(channels.keys()), f, indent=2)
+    def configure(self, settings):
+        settings = self.validate(settings)
+        with self.lock:
+            self.settings = settings
+            self.buckets.clear()
 
-def save_messages():
-    with open(MESSAGES_FILE, 'w') as f:
-        json.dump(channels, f, indent=2)
+    def take(self, route_class, session_id, username, ip):
+        """Spend a token from each bucket the request falls in; returns seconds to wait if one is empty"""
+        rates = self.settings["rates"].get(route_class)
+        if rates is None:
+            return None
+        if ip in ("127.0.0.1", "::1"):
+            ip = None
+        keys = [(kind, key) for kind, key in zip(self.kinds, (session_id, username, ip)) if key and rates[kind]]
+        
+        now = time.monotonic()
+        wait = 0
+        taken = []
+        with self.lock:
+            for kind, key in keys:
+                rate, burst = rates[kind]
+                bucket_key = (route_class, kind, key)
+                bucket = self.buckets.get(bucket_key)
+                if bucket is None:
+                    bucket = self.buckets[bucket_key] = [burst, now]
+                else:
+                    self.buckets.move_to_end(bucket_key)
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                if bucket[0] < 1:
+                    wait = max(wait, (1 - bucket[0]) / rate)
+                taken.append(bucket)
+            while len(self.buckets) > RATE_LIMIT_BUCKETS:
+                self.buckets.popitem(last=False)
+            if wait:
+                return wait
+            for bucket in taken:
+                bucket[0] -= 1
+        return None
+
+    def reserve_body(self, length):
+        """Count a body against the in-flight cap; one body alone is always let through"""
+        with self.lock:
+            if self.body_bytes and self.body_bytes + length > self.settings["max_body_bytes"]:
+                return False
+            self.body_bytes += length
+            return True
+
+    def release_body(self, length):
+        with self.lock:
+            self.body_bytes -= length
+
+    def start_upload(self):
+        with self.lock:
+            if self.uploads >= self.settings["max_uploads"]:
+                return False
+            self.uploads += 1
+            return True
+
+    def finish_upload(self):
+        with self.lock:
+            self.uploads -= 1
 
+admission = AdmissionControl()
+
+# The save_* functions copy state under its lock and write the copy outside
+# it. Handlers don't call them directly: they mark the state dirty with
+# persistence.mark() and the writer thread saves it.
 def save_users():
-    with open(USERS_FILE, 'w') as f:
-        json.dump(registered_users, f, indent=2)
+    # Don't write users.json over with the few users that signed up before it was read
+    users_loaded.wait()
+    with users_lock:
+        users = dict(registered_users)
+    write_json(USERS_FILE, users)
 
 def save_banned_users():
-    with open(BANNED_USERS_FILE, 'w') as f:
-        json.dump(banned_users, f, indent=2)
+    with moderation_lock.read():
+        banned = sorted(banned_users)
+    write_json(BANNED_USERS_FILE, banned)
 
 def save_restricted():
-    with open(RESTRICTED_FILE, 'w') as f:
-        json.dump(restricted_channels, f, indent=2)
+    with moderation_lock.read():
+        restricted = {ch: sorted(users) for ch, users in restricted_channels.items()}
+    write_json(RESTRICTED_FILE, restricted)
+
+class ModerationJournal:
+    """Admin changes made since the channel and moderation files were last written.
+
+    Each channel created or deleted, ban, unban, restriction or lifted
+    restriction is appended as one JSON line, so an admin action costs a line
+    rather than rewriting every file. Once MODERATION_JOURNAL_MAX entries have
+    built up, and at startup, the files are rewritten from memory and the
+    journal starts over. Every change sets state rather than toggling it, so
+    replaying the journal over files that already include some of it ends in
+    the same place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.pending = []
+        self.entries = 0
+
+    def load(self):
+        """The journal's entries, up to any line a crash cut short"""
+        changes = []
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        changes.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        self.entries = len(changes)
+        return changes
+
+    def record(self, event):
+        with self.lock:
+            self.pending.append(event)
+
+    def flush(self):
+        """Append what has been recorded, or rewrite the files if the journal is long enough"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        if self.entries + len(pending) > MODERATION_JOURNAL_MAX:
+            self.compact()
+            return
+        with open(self.path, 'ab') as f:
+            f.write(b"".join(json.dumps(event, separators=(',', ':')).encode() + b"\n" for event in pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries += len(pending)
+
+    def compact(self):
+        # Changes recorded while this runs land in the new journal and are replayed harmlessly
+        save_channels()
+        save_banned_users()
+        save_restricted()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.entries = 0
+
+moderation_journal = ModerationJournal(MODERATION_FILE)
+
+def save_limits():
+    write_json(LIMITS_FILE, admission.settings)
+
+def save_snapshot():
+    """Save each loaded channel's live seqs and id hashes so the next start can skip its log"""
+    sections = []
+    for name in channel_names():
+        channel_data = get_channel(name, load=False)
+        if channel_data is None:
+            continue
+        with channel_data["lock"].read():
+            if channel_data["deleted"]:
+                continue
+            if not channel_data["loaded"]:
+                sections.append((name, None, 0, None, None))
+                continue
+            marker = message_log.mark(name)
+            cold_deleted = channel_data["cold_deleted"]
+            if cold_deleted:
+                cold = [(seq, key) for seq, key in zip(channel_data["cold_seqs"], channel_data["cold_ids"])
+                        if seq not in cold_deleted]
+                seqs = array('q', (seq for seq, _ in cold))
+                ids = array('q', (key for _, key in cold))
+            else:
+                seqs = array('q', channel_data["cold_seqs"])
+                ids = array('q', channel_data["cold_ids"])
+            hot = live_messages(channel_data)
+            seqs.extend(msg.seq for msg in hot)
+            ids.extend(id_hash(msg.id) for msg in hot)
+            seq = channel_data["seq"]
+        # Written out and synced with the channel unlocked, so sends carry on meanwhile
+        point = message_log.snapshot_point(name, marker)
+        if point is not None:
+            sections.append((name, point, seq, seqs, ids))
+    message_log.write_snapshot(sections)
+
+class PersistenceWriter:
+    """Background thread that saves dirty state in batches (group commit).
+
+    Handlers call mark() with the names of the stores they changed. The
+    writer saves every store marked since its last pass in one go, so a
+    burst of requests costs one write and one fsync per store rather than
+    one each. In "strict" mode mark() blocks until a pass that started
+    after the call has finished; otherwise it returns at once.
+    """
+
+    def __init__(self, savers, mode=DURABILITY, interval=FLUSH_INTERVAL_MS / 1000):
+        self.savers = savers
+        self.mode = mode
+        self.interval = interval
+        self.cond = Condition(Lock())
+        self.flush_lock = Lock()
+        self.dirty = set()
+        self.marked = 0
+        self.flushed = 0
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        if self.mode != "shutdown":
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def mark(self, *names):
+        with self.cond:
+            self.dirty.update(names)
+            self.marked += 1
+            ticket = self.marked
+            self.cond.notify_all()
+            if self.mode == "strict" and self.thread is not None:
+                while self.flushed < ticket and not self.stopped:
+                    self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+            if self.mode == "interval":
+                time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Save everything marked so far; returns once it is on disk"""
+        with self.flush_lock:
+            with self.cond:
+                names, self.dirty = self.dirty, set()
+                ticket = self.marked
+            for name in sorted(names):
+                started = time.perf_counter()
+                try:
+                    self.savers[name]()
+                except Exception as e:
+                    print(f"Error saving {name}: {e}")
+                    metrics.add("rycord_save_errors_total", store=name)
+                    with self.cond:
+                        self.dirty.add(name)
+                metrics.histogram("rycord_save_seconds", store=name).observe(time.perf_counter() - started)
+            with self.cond:
+                self.flushed = max(self.flushed, ticket)
+                self.cond.notify_all()
+
+    def close(self):
+        """Stop the writer thread and save whatever is still dirty"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+persistence = PersistenceWriter({
+    "messages": save_messages,
+    "users": save_users,
+    "moderation": moderation_journal.flush,
+    "search": search_index.save,
+    "snapshot": save_snapshot,
+    "limits": save_limits
+})
+
+def resident_memory():
+    """Resident set size in bytes, or None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def collect_gauges():
+    messages = resident = 0
+    names = channel_names()
+    for name in names:
+        channel_data = get_channel(name, load=False)
+        if channel_data is None or not channel_data["loaded"]:
+            continue
+        with channel_data["lock"].read():
+            hot = len(channel_data["messages"]) - channel_data["holes"]
+            messages += hot + len(channel_data["cold_seqs"]) - len(channel_data["cold_deleted"])
+            resident += hot
+    with users_lock:
+        registered = len(registered_users)
+    return {
+        "rycord_uptime_seconds": time.time() - metrics.started,
+        "rycord_channels": len(names),
+        "rycord_messages": messages,
+        "rycord_resident_messages": resident,
+        "rycord_registered_users": registered,
+        "rycord_sessions": len(sessions.sessions),
+        "rycord_online_users": len(sessions.online()[1]),
+        "rycord_search_documents": len(search_index.doc_seq),
+        "rycord_response_cache_bytes": response_cache.size,
+        "rycord_uploads_in_flight": admission.uploads,
+        "rycord_body_bytes_in_flight": admission.body_bytes,
+        "rycord_threads": active_count(),
+        "rycord_resident_memory_bytes": resident_memory()
+    }
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def format_prometheus(counters, histograms, gauges):
+    """Render metrics in the Prometheus text exposition format"""
+    lines = []
+    typed = set()
+    for family, labels, value in counters:
+        if family not in typed:
+            typed.add(family)
+            lines.append(f"# TYPE {family} counter")
+        lines.append(f"{family}{prometheus_labels(labels)} {value}")
+    for family, labels, (counts, total) in histograms:
+        if family not in typed:
+            typed.add(family)
+            lines.append(f"# TYPE {family} histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{family}_bucket{prometheus_labels({**labels, 'le': bound})} {cumulative}")
+        lines.append(f"{family}_sum{prometheus_labels(labels)} {total}")
+        lines.append(f"{family}_count{prometheus_labels(labels)} {cumulative}")
+    for name, value in gauges.items():
+        if value is not None:
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def summarize_histogram(snapshot):
+    counts, total = snapshot
+    count = sum(counts)
+    return {
+        "count": count,
+        "mean_ms": total / count * 1000 if count else 0,
+        "p50_ms": bucket_quantile(counts, 0.50) * 1000,
+        "p95_ms": bucket_quantile(counts, 0.95) * 1000,
+        "p99_ms": bucket_quantile(counts, 0.99) * 1000
+    }
+
+def metrics_summary(counters, histograms, gauges):
+    """The same metrics grouped by route, lock and store for people to read.
+
+    Percentiles are bucket upper bounds, so they are only as fine as
+    LATENCY_BUCKETS.
+    """
+    routes, locks, saves, refused = {}, {}, {}, {}
+    for family, labels, value in counters:
+        if family == "rycord_requests_total":
+            route = routes.setdefault(f"{labels['method']} {labels['route']}", {"requests": 0, "statuses": {}})
+            route["requests"] += value
+            route["statuses"][labels["status"]] = value
+        elif family == "rycord_request_bytes_total":
+            route = routes.setdefault(f"{labels['method']} {labels['route']}", {"requests": 0, "statuses": {}})
+            route["bytes_" + labels["direction"]] = value
+        elif family == "rycord_save_errors_total":
+            saves.setdefault(labels["store"], {})["errors"] = value
+        elif family == "rycord_refused_requests_total":
+            refused[labels["reason"]] = value
+    for family, labels, snapshot in histograms:
+        summary = summarize_histogram(snapshot)
+        if family == "rycord_request_seconds":
+            routes.setdefault(f"{labels['method']} {labels['route']}", {"requests": 0, "statuses": {}}).update(summary)
+        elif family in ("rycord_lock_wait_seconds", "rycord_lock_hold_seconds") and summary["count"]:
+            kind = "wait" if family == "rycord_lock_wait_seconds" else "hold"
+            locks.setdefault(f"{labels['lock']} {labels['mode']}", {})[kind] = summary
+        elif family == "rycord_save_seconds":
+            saves.setdefault(labels["store"], {}).update(summary)
+    return {
+        "status": "ok",
+        "gauges": gauges,
+        "routes": dict(sorted(routes.items())),
+        "locks": locks,
+        "saves": saves,
+        "refused": refused,
+        "profiler": profiler.summary()
+    }
+
+# Changes to shared state are described as events and made by apply_event().
+# Handlers call submit() (or publish()) rather than changing state themselves,
+# so that in multi-process mode the broker can put every worker's changes in
+# one order and have each process make them the same way. Only the owner,
+# the one process that writes to disk, logs them and marks them for saving.
+cluster = None
+
+def as_message(msg):
+    return Message.from_dict(msg) if isinstance(msg, dict) else msg
+
+def encode_event(event):
+    return json.dumps(event, separators=(',', ':'), default=Message.to_dict).encode() + b"\n"
+
+def apply_message(event, owner):
+    channel = event["channel"]
+    message = as_message(event["msg"])
+    channel_data = get_channel(channel)
+    if channel_data is None:
+        return {"stored": False}
+    with channel_data["lock"].write():
+        if channel_data["deleted"]:
+            return {"stored": False}
+        if not append_message(channel_data, message):
+            existing = get_message(channel_data, message.id)
+            return {"stored": False, "author": existing.username if existing else None}
+        if owner:
+            message_log.append(channel, message)
+        search_index.add(channel, message)
+    if owner:
+        persistence.mark("messages")
+    notifier.notify("channel:" + channel)
+    return {"stored": True}
+
+def apply_file(event, owner):
+    """Adopt an uploaded file into the blob store and post its message"""
+    message = as_message(event["msg"])
+    if owner:
+        try:
+            added = blob_store.add(event["path"], event["digest"], message.file_id, event["metadata"], replace=False)
+        except OSError:
+            return {"error": "Failed to save file"}
+        if added is None:
+            # The id is taken, most likely by this same upload retried
+            return {"stored": False}
+    else:
+        forget_file_metadata(message.file_id)
+    result = apply_message(dict(event, msg=message), owner)
+    if owner and not result["stored"]:
+        blob_store.release(message.file_id)
+    return result
+
+def apply_delete(event, owner):
+    channel = event["channel"]
+    channel_data = get_channel(channel)
+    msg = None
+    if channel_data is not None:
+        with channel_data["lock"].write():
+            if not channel_data["deleted"]:
+                msg = get_message(channel_data, event["id"])
+            if msg is not None and msg.username == event["username"]:
+                seq = remove_message(channel_data, msg)
+                if owner:
+                    message_log.delete(channel, msg, seq)
+                search_index.remove(channel, msg.seq)
+    
+    if msg is None:
+        return {"error": "Message not found"}
+    if msg.username != event["username"]:
+        return {"error": "Not authorized"}
+    
+    if owner:
+        persistence.mark("messages")
+        if msg.file_id:
+            blob_store.release(msg.file_id)
+    elif msg.file_id:
+        forget_file_metadata(msg.file_id)
+    notifier.notify("channel:" + channel)
+    return {}
+
+def apply_signup(event, owner):
+    users_loaded.wait()
+    with users_lock:
+        if event["username"] in registered_users:
+            return {"error": "Username already exists"}
+        registered_users[event["username"]] = event["user"]
+    if owner:
+        persistence.mark("users")
+    return {}
+
+def apply_session(event, owner):
+    sessions.create(event["username"], event["color"], event["id"])
+    notifier.notify("users")
+    return {}
+
+def apply_touch(event, owner):
+    came_online = sessions.touch(event["id"])
+    if came_online is None:
+        return {"error": "Invalid session"}
+    if came_online:
+        notifier.notify("users")
+    return {}
+
+def apply_admin_session(event, owner):
+    admin_sessions[event["id"]] = event["time"]
+    return {}
+
+def set_banned(username, banned):
+    """Ban or unban a user; False if that changes nothing"""
+    with moderation_lock.write():
+        if (username in banned_users) == banned:
+            return False
+        if banned:
+            banned_users.add(username)
+        else:
+            banned_users.discard(username)
+    return True
+
+def set_restricted(channel, username, restricted):
+    """Keep a user out of a channel or let them back in; False if that changes nothing"""
+    with moderation_lock.write():
+        if (username in restricted_channels.get(channel, ())) == restricted:
+            return False
+        if restricted:
+            restricted_channels.setdefault(channel, set()).add(username)
+            user_restrictions.setdefault(username, set()).add(channel)
+        else:
+            unrestrict(channel, username)
+    return True
+
+def unrestrict(channel, username):
+    """Drop one restriction from both indexes; call with moderation_lock held for writing"""
+    for index, key, value in ((restricted_channels, channel, username), (user_restrictions, username, channel)):
+        values = index[key]
+        values.discard(value)
+        if not values:
+            del index[key]
+
+def moderation_changed(event, owner):
+    if owner:
+        moderation_journal.record(event)
+        persistence.mark("moderation")
+    notifier.notify("channels")
+
+def apply_ban(event, owner):
+    if set_banned(event["username"], event["op"] == "ban"):
+        moderation_changed(event, owner)
+    return {}
+
+def apply_restrict(event, owner):
+    if get_channel(event["channel"], load=False) is None:
+        return {"error": "Channel not found"}
+    if set_restricted(event["channel"], event["username"], event["op"] == "restrict"):
+        moderation_changed(event, owner)
+    return {}
+
+def apply_create_channel(event, owner):
+    name = event["channel"]
+    with channels_lock.write():
+        if name in channels:
+            return {"error": "Channel already exists"}
+        # Not loaded, so a journal replay at startup still reads the channel's log
+        channels[name] = new_channel(name, loaded=False)
+    moderation_changed(event, owner)
+    return {}
+
+def apply_delete_channel(event, owner):
+    """Remove a channel with its restrictions, and on the owner its log and attachments"""
+    name = event["channel"]
+    with channels_lock.write():
+        channel_data = channels.pop(name, None)
+    if channel_data is None:
+        return {"error": "Channel not found"}
+    
+    if owner:
+        ensure_loaded(channel_data)
+    with channel_data["lock"].write():
+        channel_data["deleted"] = True
+        snapshot = snapshot_history(channel_data) if owner else None
+        search_index.drop_channel(name)
+    with moderation_lock.write():
+        for username in list(restricted_channels.get(name, ())):
+            unrestrict(name, username)
+    
+    if owner:
+        file_ids = [msg.file_id for msg in iter_history(channel_data, snapshot) if msg.file_id]
+        message_log.drop(name)
+        for file_id in file_ids:
+            blob_store.release(file_id)
+        persistence.mark("search", "snapshot")
+    moderation_changed(event, owner)
+    notifier.notify("channel:" + name)
+    return {}
+
+def string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def admin_data_changes(wanted_channels, wanted_banned, wanted_restricted):
+    """The moderation events that turn the current settings into an admin's edit of all of them"""
+    names = channel_names()
+    wanted_channels = list(dict.fromkeys(ch for ch in wanted_channels if isinstance(ch, str)))
+    with moderation_lock.read():
+        banned = set(banned_users)
+        restricted = {ch: set(users) for ch, users in restricted_channels.items()}
+    
+    changes = [{"op": "create_channel", "channel": ch} for ch in wanted_channels if ch not in names]
+    changes += [{"op": "delete_channel", "channel": ch} for ch in names if ch not in wanted_channels]
+    wanted_banned = {u for u in wanted_banned if isinstance(u, str)}
+    changes += [{"op": "ban", "username": u} for u in sorted(wanted_banned - banned)]
+    changes += [{"op": "unban", "username": u} for u in sorted(banned - wanted_banned)]
+    for ch in wanted_channels:
+        users = restricted.get(ch, set())
+        wanted = {u for u in wanted_restricted.get(ch, ()) if isinstance(u, str)}
+        changes += [{"op": "restrict", "channel": ch, "username": u} for u in sorted(wanted - users)]
+        changes += [{"op": "unrestrict", "channel": ch, "username": u} for u in sorted(users - wanted)]
+    return changes
+
+def apply_limits(event, owner):
+    admission.configure(event["limits"])
+    if owner:
+        persistence.mark("limits")
+    return {}
+
+change_appliers = {
+    "message": apply_message,
+    "file": apply_file,
+    "delete": apply_delete,
+    "signup": apply_signup,
+    "session": apply_session,
+    "touch": apply_touch,
+    "admin_session": apply_admin_session,
+    "ban": apply_ban,
+    "unban": apply_ban,
+    "restrict": apply_restrict,
+    "unrestrict": apply_restrict,
+    "create_channel": apply_create_channel,
+    "delete_channel": apply_delete_channel,
+    "limits": apply_limits
+}
+
+def apply_event(event, owner=True):
+    """Make the change an event describes; a result with "error" means nothing changed"""
+    return change_appliers[event["op"]](event, owner)
+
+def submit(event):
+    """Make a change and return its result.
+
+    In multi-process mode the event goes through the broker, and this
+    returns once the calling worker has applied it too.
+    """
+    if cluster is None:
+        return apply_event(event)
+    return cluster.submit(event)
+
+def publish(event):
+    """Make a change here at once; other processes catch up without being waited for"""
+    if cluster is None:
+        return apply_event(event)
+    return cluster.publish(event)
+
+class ClusterLink:
+    """A worker process's connection to the broker.
+
+    Events are sent as JSON lines over a Unix socket. The reader thread
+    applies every event the broker sends back, in the broker's order, and
+    wakes the request that submitted one once it has been applied here.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = Lock()
+        self.waiting = {}
+        self.tickets = count(1)
+
+    def submit(self, event):
+        ticket = next(self.tickets)
+        waiter = self.waiting[ticket] = [Event(), None]
+        self.send(dict(event, ticket=ticket))
+        waiter[0].wait()
+        return waiter[1]
+
+    def publish(self, event):
+        result = apply_event(event, owner=False)
+        if not result.get("error"):
+            self.send(dict(event, echo=False))
+        return result
+
+    def send(self, event):
+        data = encode_event(event)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def run(self):
+        with self.sock.makefile('rb') as f:
+            for line in f:
+                event = json.loads(line)
+                ticket = event.pop("ticket", None)
+                if event["op"] == "failed":
+                    result = {"error": event["message"]}
+                else:
+                    try:
+                        result = apply_event(event, owner=False)
+                    except Exception as e:
+                        print(f"Error applying {event['op']}: {e}")
+                        result = {"error": "Internal error"}
+                waiter = self.waiting.pop(ticket, None)
+                if waiter is not None:
+                    waiter[1] = result
+                    waiter[0].set()
+        print("Lost the connection to the broker, stopping worker")
+        os._exit(1)
+
+class Broker:
+    """Puts the worker processes' changes in one order and fans them out.
+
+    Runs in the parent process, which keeps its own copy of the state and is
+    the only process that writes to disk. Each event is applied here first:
+    one that fails goes back to its sender only, anything else goes to every
+    worker, so they all make the same changes in the same order. The sender's
+    copy carries its ticket; events that were published have already been
+    applied by their sender and aren't sent back to it.
+    """
+
+    def __init__(self, connections):
+        self.connections = dict(enumerate(connections))
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        for number, conn in self.connections.items():
+            self.selector.register(conn, selectors.EVENT_READ, number)
+            self.buffers[number] = b""
+
+    def run(self):
+        """Relay events until every worker has gone"""
+        while self.connections:
+            for key, _ in self.selector.select():
+                number = key.data
+                if number not in self.connections:
+                    continue
+                try:
+                    data = key.fileobj.recv(1 << 16)
+                except OSError:
+                    data = b""
+                if not data:
+                    self.drop(number)
+                    continue
+                *lines, self.buffers[number] = (self.buffers[number] + data).split(b"\n")
+                for line in lines:
+                    self.handle(number, json.loads(line))
+
+    def handle(self, origin, event):
+        ticket = event.pop("ticket", None)
+        echo = event.pop("echo", True)
+        try:
+            result = apply_event(event)
+        except Exception as e:
+            print(f"Error applying {event.get('op')}: {e}")
+            result = {"error": "Internal error"}
+        if result.get("error"):
+            if ticket is not None:
+                self.send(origin, encode_event({"op": "failed", "message": result["error"], "ticket": ticket}))
+            return
+        
+        data = encode_event(event)
+        for number in list(self.connections):
+            if number != origin:
+                self.send(number, data)
+            elif echo:
+                self.send(number, encode_event(dict(event, ticket=ticket)))
+
+    def send(self, number, data):
+        conn = self.connections.get(number)
+        if conn is None:
+            return
+        try:
+            conn.sendall(data)
+        except OSError:
+            self.drop(number)
+
+    def drop(self, number):
+        conn = self.connections.pop(number)
+        self.selector.unregister(conn)
+        conn.close()
+        print(f"Worker {number} has stopped")
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -121,9 +3327,92 @@ def get_random_color():
     colors = ['#ed4245', '#f57c00', '#ffa500', '#43b581', '#00acc1', '#5865f2', '#9c27b0', '#e91e63']
     return random.choice(colors)
 
+class CountingWriter:
+    """Wraps a handler's wfile to count the bytes sent to the client"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
 class ChatHandler(BaseHTTPRequestHandler):
+    timeout = REQUEST_TIMEOUT
+    
+    # Paths that are counted under their own name in the metrics; anything
+    # else is counted as "other" so stray URLs can't add series without end
+    metric_paths = {
+        '/', '/admin', '/styles.css', '/admin-styles.css', '/app.js', '/admin.js',
+        '/api/channels', '/api/messages', '/api/stream', '/api/search', '/api/users',
+        '/api/upload/status', '/api/admin/data', '/api/admin/metrics', '/api/admin/profile',
+        '/api/admin/limits', '/api/signup', '/api/login', '/api/send', '/api/upload',
+        '/api/upload/init', '/api/upload/chunk', '/api/upload/finalize', '/api/upload/raw',
+        '/api/delete', '/api/heartbeat', '/api/sync', '/api/admin/login', '/api/admin/ban',
+        '/api/admin/unban', '/api/admin/restrict', '/api/admin/unrestrict',
+        '/api/admin/channels/create', '/api/admin/channels/delete'
+    }
+    # Likewise for request methods, which come straight from the client
+    metric_methods = {'GET', 'POST', 'HEAD'}
+    # Admin moderation routes: the change each makes and the fields it takes
+    moderation_routes = {
+        '/api/admin/ban': ("ban", ("username",)),
+        '/api/admin/unban': ("unban", ("username",)),
+        '/api/admin/restrict': ("restrict", ("channel", "username")),
+        '/api/admin/unrestrict': ("unrestrict", ("channel", "username")),
+        '/api/admin/channels/create': ("create_channel", ("channel",)),
+        '/api/admin/channels/delete': ("delete_channel", ("channel",))
+    }
+    # Admission control: the rate limit class of each POST route (GET /api/
+    # routes other than the admin ones are "read"), the routes that carry
+    # file data, and those whose bodies are streamed rather than read whole
+    route_classes = {
+        '/api/signup': 'auth', '/api/login': 'auth', '/api/admin/login': 'auth',
+        '/api/send': 'send', '/api/delete': 'send',
+        '/api/upload': 'upload', '/api/upload/init': 'upload', '/api/upload/raw': 'upload',
+        '/api/sync': 'read', '/api/heartbeat': 'read'
+    }
+    upload_routes = {'/api/upload', '/api/upload/chunk', '/api/upload/raw'}
+    streamed_routes = {'/api/upload/chunk', '/api/upload/raw'}
+    
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+    
+    def handle_one_request(self):
+        self.status = None
+        self.started = time.perf_counter()
+        self.wfile.written = 0
+        self.headers = None
+        super().handle_one_request()
+        if self.status is not None:
+            try:
+                bytes_in = int(self.headers.get('Content-Length') or 0) if self.headers else 0
+            except ValueError:
+                bytes_in = 0
+            method = self.command if self.command in self.metric_methods else 'other'
+            metrics.request(method, self.metric_route(), self.status,
+                            time.perf_counter() - self.started, bytes_in, self.wfile.written)
+    
+    def metric_route(self):
+        path = urlparse(getattr(self, 'path', '')).path
+        for prefix in ('/api/file/', '/api/message/'):
+            if path.startswith(prefix):
+                return prefix + '<id>'
+        return path if path in self.metric_paths else 'other'
+    
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+    
     def do_GET(self):
         parsed = urlparse(self.path)
+        if not self.admit(parsed):
+            return
         
         if parsed.path == '/':
             self.serve_file('index.html', 'text/html')
@@ -141,29 +3430,74 @@ class ChatHandler(BaseHTTPRequestHandler):
             self.get_channels()
         elif parsed.path.startswith('/api/messages'):
             self.get_messages(parsed)
+        elif parsed.path.startswith('/api/message/'):
+            self.get_message_by_id(parsed)
+        elif parsed.path == '/api/stream':
+            self.stream(parsed)
         elif parsed.path == '/api/users':
             self.get_users()
+        elif parsed.path == '/api/search':
+            self.search(parsed)
+        elif parsed.path == '/api/upload/status':
+            self.upload_status(parsed)
         elif parsed.path.startswith('/api/file/'):
             self.get_file(parsed.path)
         elif parsed.path.startswith('/api/admin/data'):
             self.get_admin_data(parsed)
+        elif parsed.path == '/api/admin/metrics':
+            self.get_metrics(parsed)
+        elif parsed.path == '/api/admin/profile':
+            self.get_profile(parsed)
+        elif parsed.path == '/api/admin/limits':
+            self.get_limits(parsed)
         else:
             self.send_error(404)
     
     def serve_file(self, filename, content_type):
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                content = f.read()
-            self.send_response(200)
-            self.send_header('Content-type', content_type)
-            self.end_headers()
-            self.wfile.write(content.encode())
-        except FileNotFoundError:
+        entry = static_cache.get(filename)
+        if entry is None:
             self.send_error(404)
+            return
+        
+        if entry["gzip"] is not None and self.accepts_gzip():
+            body, etag = entry["gzip"], entry["gzip_etag"]
+        else:
+            body, etag = entry["body"], entry["etag"]
+        
+        if self.not_modified(etag, entry["modified"]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(entry["modified"], usegmt=True))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if body is entry["gzip"]:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def accepts_gzip(self):
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip() in ('gzip', '*'):
+                return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
     
     def do_POST(self):
         parsed = urlparse(self.path)
-        
+        try:
+            if self.admit(parsed):
+                self.handle_post(parsed)
+        finally:
+            self.release()
+    
+    def handle_post(self, parsed):
         if parsed.path == '/api/signup':
             self.signup()
         elif parsed.path == '/api/login':
@@ -172,70 +3506,162 @@ class ChatHandler(BaseHTTPRequestHandler):
             self.send_message()
         elif parsed.path == '/api/upload':
             self.upload_file()
+        elif parsed.path == '/api/upload/init':
+            self.upload_init()
+        elif parsed.path == '/api/upload/chunk':
+            self.upload_chunk(parsed)
+        elif parsed.path == '/api/upload/finalize':
+            self.upload_finalize()
+        elif parsed.path == '/api/upload/raw':
+            self.upload_raw(parsed)
         elif parsed.path == '/api/delete':
             self.delete_message()
         elif parsed.path == '/api/heartbeat':
             self.heartbeat()
+        elif parsed.path == '/api/sync':
+            self.sync()
         elif parsed.path == '/api/admin/login':
             self.admin_login()
         elif parsed.path == '/api/admin/data':
             self.save_admin_data_api()
+        elif parsed.path == '/api/admin/profile':
+            self.set_profiler()
+        elif parsed.path == '/api/admin/limits':
+            self.set_limits()
+        elif parsed.path in self.moderation_routes:
+            self.moderate(*self.moderation_routes[parsed.path])
         else:
             self.send_error(404)
     
+    def admit(self, parsed):
+        """Apply admission control; returns False once the request has been refused.
+
+        The JSON body of a POST is read and parsed into self.body first, as
+        that's where the session is; do_POST calls release() afterwards.
+        """
+        self.body = None
+        self.reserved = 0
+        self.upload_slot = False
+        path = parsed.path
+        if self.command != 'POST':
+            if path.startswith('/api/') and not path.startswith('/api/admin'):
+                return self.check_rate('read', None, None)
+            return True
+        
+        if path in self.upload_routes:
+            if not admission.start_upload():
+                return self.refuse(503, "Too many uploads in progress", 1, "uploads")
+            self.upload_slot = True
+        
+        session_id = None
+        if path in self.streamed_routes:
+            session_id = parse_qs(parsed.query).get('sessionId', [None])[0]
+        else:
+            length = self.content_length()
+            if length is None:
+                self.close_connection = True
+                self.send_json({"status": "error", "message": "Content-Length required"}, 411)
+                return False
+            if path == '/api/upload':
+                if length > MAX_FILE_SIZE * 4 // 3 + UPLOAD_JSON_OVERHEAD:
+                    self.close_connection = True
+                    self.send_json({"status": "error", "message": "File too large. Maximum size is 100MB."}, 413)
+                    return False
+            elif length > MAX_JSON_BODY:
+                self.close_connection = True
+                self.send_json({"status": "error", "message": "Request body too large"}, 413)
+                return False
+            if not admission.reserve_body(length):
+                return self.refuse(503, "Server busy", 1, "body_bytes")
+            self.reserved = length
+            try:
+                self.body = json.loads(self.rfile.read(length).decode())
+            except ValueError:
+                self.body = None
+            if not isinstance(self.body, dict):
+                self.send_json({"status": "error", "message": "Invalid JSON"}, 400)
+                return False
+            session_id = self.body.get('sessionId')
+        
+        route_class = self.route_classes.get(path)
+        if route_class is None:
+            return True
+        if not isinstance(session_id, str):
+            session_id = None
+        if route_class == 'auth':
+            username = self.body.get('username')
+            username = username.strip() if isinstance(username, str) else None
+        else:
+            session = sessions.get(session_id) if session_id else None
+            username = session["username"] if session else None
+        return self.check_rate(route_class, session_id, username)
+    
+    def check_rate(self, route_class, session_id, username):
+        wait = admission.take(route_class, session_id, username, self.client_address[0])
+        if wait is None:
+            return True
+        return self.refuse(429, "Too many requests, slow down", wait, "rate_" + route_class)
+    
+    def refuse(self, status, message, retry_after, reason):
+        metrics.add("rycord_refused_requests_total", reason=reason)
+        # The body may not have been read, so the connection can't be reused
+        self.close_connection = True
+        self.send_json({"status": "error", "message": message}, status,
+                       {"Retry-After": str(max(1, math.ceil(retry_after)))})
+        return False
+    
+    def release(self):
+        if self.reserved:
+            admission.release_body(self.reserved)
+            self.reserved = 0
+        if self.upload_slot:
+            admission.finish_upload()
+            self.upload_slot = False
+        self.body = None
+    
     def signup(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
         
         username = data.get('username', '').strip()
         password = data.get('password', '')
         
-        with data_lock:
-            if username in registered_users:
-                self.send_json({"status": "error", "message": "Username already exists"})
-                return
-            
-            if username in banned_users:
-                self.send_json({"status": "error", "message": "You are banned from RyCord"})
-                return
-            
-            registered_users[username] = {
-                "password_hash": hash_password(password),
-                "color": get_random_color()
-            }
-            save_users()
+        with moderation_lock.read():
+            banned = username in banned_users
+        if banned:
+            self.send_json({"status": "error", "message": "You are banned from RyCord"})
+            return
+        
+        result = submit({"op": "signup", "username": username, "user": {
+            "password_hash": hash_password(password),
+            "color": get_random_color()
+        }})
+        if result.get("error"):
+            self.send_json({"status": "error", "message": result["error"]})
+            return
         
         self.send_json({"status": "ok"})
     
     def login(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
         
         username = data.get('username', '').strip()
         password = data.get('password', '')
         
-        with data_lock:
-            if username in banned_users:
-                self.send_json({"status": "error", "message": "You are banned from RyCord"})
-                return
-            
-            if username not in registered_users:
-                self.send_json({"status": "error", "message": "Invalid username or password"})
-                return
-            
-            user = registered_users[username]
-            if user["password_hash"] != hash_password(password):
-                self.send_json({"status": "error", "message": "Invalid username or password"})
-                return
-            
-            session_id = str(uuid.uuid4())
-            active_sessions[session_id] = {
-                "username": username,
-                "last_seen": datetime.now().timestamp(),
-                "color": user["color"]
-            }
+        with moderation_lock.read():
+            banned = username in banned_users
+        if banned:
+            self.send_json({"status": "error", "message": "You are banned from RyCord"})
+            return
+        
+        users_loaded.wait()
+        with users_lock:
+            user = registered_users.get(username)
+        if user is None or user["password_hash"] != hash_password(password):
+            self.send_json({"status": "error", "message": "Invalid username or password"})
+            return
+        
+        session_id = str(uuid.uuid4())
+        submit({"op": "session", "id": session_id, "username": username, "color": user["color"]})
         
         self.send_json({
             "status": "ok",
@@ -244,153 +3670,325 @@ class ChatHandler(BaseHTTPRequestHandler):
         })
     
     def admin_login(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
         
         password = data.get('password', '')
         
-        if password == ADMIN_PASSWORD:
-            session_id = str(uuid.uuid4())
-            admin_sessions[session_id] = datetime.now().timestamp()
-            self.send_json({"status": "ok", "sessionId": session_id})
+        if password == ADMIN_PASSWORD:
+            session_id = str(uuid.uuid4())
+            submit({"op": "admin_session", "id": session_id, "time": datetime.now().timestamp()})
+            self.send_json({"status": "ok", "sessionId": session_id})
+        else:
+            self.send_json({"status": "error", "message": "Invalid password"})
+    
+    def get_admin_data(self, parsed):
+        params = parse_qs(parsed.query)
+        session = params.get('session', [''])[0]
+        
+        if session not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"})
+            return
+        
+        data = {"channels": channel_names()}
+        users_loaded.wait()
+        with users_lock:
+            data["users"] = list(registered_users.keys())
+        with moderation_lock.read():
+            data["banned_users"] = sorted(banned_users)
+            data["restricted_channels"] = {ch: sorted(users) for ch, users in restricted_channels.items()}
+        
+        self.send_json(data)
+    
+    def get_metrics(self, parsed):
+        params = parse_qs(parsed.query)
+        if params.get('session', [''])[0] not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"}, 401)
+            return
+        
+        counters, histograms = metrics.series()
+        gauges = collect_gauges()
+        if params.get('format', ['json'])[0] != 'prometheus':
+            self.send_json(metrics_summary(counters, histograms, gauges))
+            return
+        
+        body = format_prometheus(counters, histograms, gauges).encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def get_profile(self, parsed):
+        """Profiler samples as collapsed stacks, for flamegraph.pl or speedscope"""
+        params = parse_qs(parsed.query)
+        if params.get('session', [''])[0] not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"}, 401)
+            return
+        
+        body = profiler.collapsed().encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def set_profiler(self):
+        data = self.body
+        
+        if data.get('sessionId', '') not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"}, 401)
+            return
+        
+        if data.get('enabled'):
+            try:
+                interval = float(data.get('interval', PROFILE_INTERVAL))
+            except (TypeError, ValueError):
+                interval = math.nan
+            if not math.isfinite(interval):
+                self.send_json({"status": "error", "message": "Invalid interval"}, 400)
+                return
+            profiler.start(min(max(interval, 0.001), 1))
         else:
-            self.send_json({"status": "error", "message": "Invalid password"})
+            profiler.stop()
+        self.send_json({"status": "ok", "profiler": profiler.summary()})
     
-    def get_admin_data(self, parsed):
+    def get_limits(self, parsed):
         params = parse_qs(parsed.query)
-        session = params.get('session', [''])[0]
-        
-        if session not in admin_sessions:
-            self.send_json({"status": "error", "message": "Unauthorized"})
+        if params.get('session', [''])[0] not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"}, 401)
+            return
+        self.send_json({"status": "ok", "limits": admission.settings})
+    
+    def set_limits(self):
+        data = self.body
+        if data.get('sessionId', '') not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"}, 401)
             return
         
-        with data_lock:
-            data = {
-                "channels": list(channels.keys()),
-                "users": list(registered_users.keys()),
-                "banned_users": banned_users,
-                "restricted_channels": restricted_channels
-            }
-        
-        self.send_json(data)
+        try:
+            limits = AdmissionControl.validate(data.get('limits') or {})
+        except ValueError as e:
+            self.send_json({"status": "error", "message": str(e)}, 400)
+            return
+        submit({"op": "limits", "limits": limits})
+        self.send_json({"status": "ok", "limits": limits})
     
     def save_admin_data_api(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
         
         session = data.get('sessionId', '')
         if session not in admin_sessions:
             self.send_json({"status": "error", "message": "Unauthorized"})
             return
         
-        with data_lock:
-            global channels, banned_users, restricted_channels
-            
-            new_channels = data.get('channels', [])
-            for ch in new_channels:
-                if ch not in channels:
-                    channels[ch] = {"name": ch, "messages": []}
-            
-            for ch in list(channels.keys()):
-                if ch not in new_channels:
-                    del channels[ch]
-            
-            banned_users = data.get('banned_users', [])
-            restricted_channels = data.get('restricted_channels', {})
-            
-            save_channels()
-            save_messages()
-            save_banned_users()
-            save_restricted()
+        wanted_channels = data.get('channels', [])
+        wanted_banned = data.get('banned_users', [])
+        wanted_restricted = data.get('restricted_channels', {})
+        # Every change is journaled and replayed, so refuse malformed edits outright
+        if not (string_list(wanted_channels) and string_list(wanted_banned) and isinstance(wanted_restricted, dict)
+                and all(string_list(users) for users in wanted_restricted.values())):
+            self.send_json({"status": "error", "message": "Invalid admin data"}, 400)
+            return
         
+        for change in admin_data_changes(wanted_channels, wanted_banned, wanted_restricted):
+            submit(change)
+        self.send_json({"status": "ok"})
+    
+    def moderate(self, op, fields):
+        """One admin change: a channel created or deleted, a ban or a restriction"""
+        data = self.body
+        if data.get('sessionId', '') not in admin_sessions:
+            self.send_json({"status": "error", "message": "Unauthorized"}, 401)
+            return
+        
+        event = {"op": op}
+        for field in fields:
+            value = data.get(field)
+            if not isinstance(value, str) or not value.strip():
+                self.send_json({"status": "error", "message": f"Missing {field}"}, 400)
+                return
+            event[field] = value.strip()
+        
+        result = submit(event)
+        if result.get("error"):
+            self.send_json({"status": "error", "message": result["error"]})
+            return
         self.send_json({"status": "ok"})
     
     def get_channels(self):
-        with data_lock:
-            data = {"channels": list(channels.keys())}
-        self.send_json(data)
+        # Read the version first: a change that lands in between only costs a rebuild
+        version = notifier.snapshot(["channels"])["channels"]
+        entry = response_cache.get(("channels",), version)
+        if entry is None:
+            entry = response_cache.put(("channels",), version, {"channels": channel_names()})
+        self.send_cached(entry)
     
     def get_messages(self, parsed):
         params = parse_qs(parsed.query)
         channel = params.get('channel', ['general'])[0]
         
-        with data_lock:
-            if channel in channels:
-                data = {"messages": channels[channel]["messages"]}
-            else:
-                data = {"messages": []}
+        try:
+            since = int(params['since'][0]) if 'since' in params else None
+            before = int(params['before'][0]) if 'before' in params else None
+            limit = int(params['limit'][0]) if 'limit' in params else None
+        except ValueError:
+            self.send_json({"status": "error", "message": "Invalid cursor"})
+            return
+        if limit is not None and limit < 1:
+            self.send_json({"status": "error", "message": "Invalid limit"}, 400)
+            return
+        after_id = params.get('after_id', [None])[0]
         
-        self.send_json(data)
+        wait = 0
+        if 'wait' in params and (since is not None or after_id is not None):
+            try:
+                wait = min(max(float(params['wait'][0]), 0), MAX_LONG_POLL)
+            except ValueError:
+                pass
+        if wait and not self.acquire_stream_slot():
+            wait = 0
+        deadline = time.monotonic() + wait
+        
+        try:
+            while True:
+                known = notifier.snapshot(["channel:" + channel])
+                entry = messages_response(channel, since, before, limit, after_id)
+                remaining = deadline - time.monotonic()
+                if entry["changed"] or remaining <= 0:
+                    break
+                since, after_id = entry["seq"], None
+                notifier.wait(known, remaining)
+        finally:
+            if wait:
+                self.release_stream_slot()
+        
+        self.send_cached(entry)
     
     def get_users(self):
-        with data_lock:
-            now = datetime.now().timestamp()
-            active_users = [
-                {"username": s["username"], "color": s["color"]}
-                for s in active_sessions.values()
-                if now - s["last_seen"] < 10
-            ]
+        version, users = sessions.online()
+        entry = response_cache.get(("users",), version)
+        if entry is None:
+            entry = response_cache.put(("users",), version, {"users": users, "version": version})
+        self.send_cached(entry)
+    
+    def stream(self, parsed):
+        """Server-Sent Events feed of one channel's messages, presence and the channel list"""
+        params = parse_qs(parsed.query)
+        channel = params.get('channel', ['general'])[0]
+        try:
+            since = int(self.headers.get('Last-Event-ID') or params.get('since', ['0'])[0])
+        except ValueError:
+            since = 0
+        
+        if not self.acquire_stream_slot():
+            self.send_response(503)
+            self.send_header('Retry-After', '5')
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
         
-        self.send_json({"users": active_users})
+        topics = ["channel:" + channel, "users", "channels"]
+        last_users = last_channels = None
+        try:
+            self.wfile.write(b"retry: 3000\n\n")
+            while True:
+                known = notifier.snapshot(topics)
+                data = query_messages(channel, since)
+                users_version, users = sessions.online()
+                names = channel_names()
+                
+                if names != last_channels:
+                    self.send_event("channels", {"channels": names})
+                    last_channels = names
+                if users_version != last_users:
+                    self.send_event("users", {"users": users, "version": users_version})
+                    last_users = users_version
+                if has_changes(data):
+                    self.send_event("messages", data, event_id=data["seq"])
+                since = data["seq"]
+                if data.get("hasMore"):
+                    continue
+                
+                waited = 0
+                while not notifier.wait(known, STREAM_PRESENCE_CHECK):
+                    waited += STREAM_PRESENCE_CHECK
+                    if sessions.online()[0] != last_users:
+                        break
+                    if waited >= STREAM_KEEPALIVE:
+                        self.wfile.write(b": keepalive\n\n")
+                        waited = 0
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.release_stream_slot()
+    
+    def acquire_stream_slot(self):
+        """Claim one of the server's slots for a request that holds its worker open"""
+        slots = getattr(self.server, 'stream_slots', None)
+        return slots is None or slots.acquire(blocking=False)
+    
+    def release_stream_slot(self):
+        slots = getattr(self.server, 'stream_slots', None)
+        if slots is not None:
+            slots.release()
+    
+    def send_event(self, event, data, event_id=None):
+        payload = f"event: {event}\n"
+        if event_id is not None:
+            payload += f"id: {event_id}\n"
+        payload += f"data: {json.dumps(data)}\n\n"
+        self.wfile.write(payload.encode())
     
     def send_message(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
         
         session_id = data.get("sessionId")
         username = data.get("username")
         channel = data.get("channel", "general")
         
-        if not session_id or session_id not in active_sessions:
-            self.send_json({"status": "error", "message": "Invalid session"})
+        error = posting_error(session_id, username, channel)
+        if error:
+            self.send_json({"status": "error", "message": error})
             return
         
-        if username in banned_users:
-            self.send_json({"status": "error", "message": "You are banned"})
+        text = data.get("text", "")
+        if not isinstance(text, str):
+            self.send_json({"status": "error", "message": "Invalid text"}, 400)
             return
         
-        if channel in restricted_channels and username in restricted_channels[channel]:
-            self.send_json({"status": "error", "message": "You cannot access this channel"})
-            return
+        message_id = data.get("id")
+        if not isinstance(message_id, str) or not message_id:
+            message_id = uuid.uuid4().hex
         
-        message = {
-            "id": data.get("id"),
-            "username": username,
-            "text": data.get("text", ""),
-            "timestamp": datetime.now().isoformat(),
-            "color": data.get("color", "#5865f2"),
-            "type": data.get("type", "text")
-        }
+        message = Message(message_id, username, text, time.time(),
+                          data.get("color", "#5865f2"), data.get("type", "text"))
         
-        with data_lock:
-            if channel in channels:
-                channels[channel]["messages"].append(message)
-                save_messages()
+        result = submit({"op": "message", "channel": channel, "msg": message})
+        # A retried send finds its message already stored and just succeeds
+        if result.get("author") not in (None, username):
+            self.send_json({"status": "error", "message": "Duplicate message id"})
+            return
         
-        self.send_json({"status": "ok"})
+        self.send_json({"status": "ok", "id": message_id})
     
     def upload_file(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
         
         session_id = data.get("sessionId")
         username = data.get("username")
         channel = data.get("channel", "general")
         
-        if not session_id or session_id not in active_sessions:
-            self.send_json({"status": "error", "message": "Invalid session"})
-            return
-        
-        if username in banned_users:
-            self.send_json({"status": "error", "message": "You are banned"})
+        error = posting_error(session_id, username, channel)
+        if error:
+            self.send_json({"status": "error", "message": error})
             return
         
-        if channel in restricted_channels and username in restricted_channels[channel]:
-            self.send_json({"status": "error", "message": "You cannot access this channel"})
+        if not isinstance(data.get("fileName"), (str, type(None))):
+            self.send_json({"status": "error", "message": "Invalid fileName"}, 400)
             return
         
         file_data = data.get("fileData")
@@ -404,170 +4002,776 @@ class ChatHandler(BaseHTTPRequestHandler):
             self.send_json({"status": "error", "message": "Invalid file data"})
             return
         
-        file_id = data.get("id")
+        file_id = safe_file_id(data.get("id"))
         mime_type = data.get("mimeType")
         
-        file_path = os.path.join(FILES_DIR, file_id)
+        temp_path = os.path.join(UPLOADS_DIR, uuid.uuid4().hex + ".part")
         try:
-            with open(file_path, 'wb') as f:
+            with open(temp_path, 'wb') as f:
                 f.write(decoded_data)
+            post_file_message(channel, temp_path, hashlib.sha256(decoded_data).hexdigest(), file_id, mime_type,
+                              username, data.get("color"), data.get("type"), data.get("fileName"),
+                              data.get("fileSize", 0))
         except Exception as e:
             self.send_json({"status": "error", "message": "Failed to save file"})
             return
         
-        metadata_path = file_path + ".meta"
-        with open(metadata_path, 'w') as f:
-            json.dump({"mimeType": mime_type, "fileName": data.get("fileName")}, f)
-        
-        message = {
-            "id": file_id,
-            "username": username,
-            "text": "",
-            "timestamp": datetime.now().isoformat(),
-            "color": data.get("color", "#5865f2"),
-            "type": data.get("type", "file"),
-            "fileId": file_id,
-            "fileName": data.get("fileName"),
-            "fileSize": data.get("fileSize", 0)
-        }
+        self.send_json({"status": "ok"})
+    
+    def content_length(self):
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            return None
+        return length if length >= 0 else None
+    
+    def copy_body(self, f, length, hasher=None):
+        """Stream a request body to a file in fixed-size chunks; returns bytes written"""
+        written = 0
+        while written < length:
+            chunk = self.rfile.read(min(UPLOAD_BUFFER_SIZE, length - written))
+            if not chunk:
+                break
+            f.write(chunk)
+            if hasher:
+                hasher[1].update(chunk)
+                hasher[0] += len(chunk)
+            written += len(chunk)
+        return written
+    
+    def upload_init(self):
+        data = self.body
         
-        with data_lock:
-            if channel in channels:
-                channels[channel]["messages"].append(message)
-                save_messages()
+        session_id = data.get("sessionId")
+        username = data.get("username")
+        channel = data.get("channel", "general")
         
-        self.send_json({"status": "ok"})
+        error = posting_error(session_id, username, channel)
+        if error:
+            self.send_json({"status": "error", "message": error})
+            return
+        
+        if not isinstance(data.get("fileName"), (str, type(None))):
+            self.send_json({"status": "error", "message": "Invalid fileName"}, 400)
+            return
+        
+        try:
+            file_size = int(data.get("fileSize", 0))
+        except (TypeError, ValueError):
+            file_size = -1
+        if file_size < 0 or file_size > MAX_FILE_SIZE:
+            self.send_json({"status": "error", "message": "File too large. Maximum size is 100MB."}, 413)
+            return
+        
+        upload = create_upload(username, channel, data.get("id"), data.get("fileName"), file_size,
+                               data.get("mimeType"), data.get("type"), data.get("color"))
+        self.send_json({
+            "status": "ok",
+            "uploadId": upload["uploadId"],
+            "offset": 0,
+            "chunkSize": UPLOAD_CHUNK_SIZE
+        })
+    
+    def upload_chunk(self, parsed):
+        params = parse_qs(parsed.query)
+        upload_id = params.get('uploadId', [''])[0]
+        length = self.content_length()
+        try:
+            offset = int(params.get('offset', ['0'])[0])
+        except ValueError:
+            offset = -1
+        
+        if length is None:
+            self.send_json({"status": "error", "message": "Content-Length required"}, 411)
+            return
+        
+        upload = load_upload(upload_id)
+        if upload is None:
+            self.send_json({"status": "error", "message": "Unknown upload"}, 404)
+            return
+        
+        error = upload_error(params.get('sessionId', [''])[0], upload)
+        if error:
+            self.send_json({"status": "error", "message": error})
+            return
+        
+        with upload_lock(upload_id):
+            upload = load_upload(upload_id)
+            if upload is None:
+                self.send_json({"status": "error", "message": "Unknown upload"}, 404)
+                return
+            if offset != upload["offset"]:
+                self.send_json({"status": "error", "message": "Offset mismatch", "offset": upload["offset"]}, 409)
+                return
+            if offset + length > upload["fileSize"]:
+                self.send_json({"status": "error", "message": "Chunk exceeds declared file size"}, 413)
+                return
+            
+            _, part_path = upload_paths(upload_id)
+            with open(part_path, 'ab') as f:
+                written = self.copy_body(f, length, upload_hasher(upload_id, offset))
+        
+        self.send_json({"status": "ok", "offset": offset + written})
+    
+    def upload_status(self, parsed):
+        params = parse_qs(parsed.query)
+        upload = load_upload(params.get('uploadId', [''])[0])
+        if upload is None:
+            self.send_json({"status": "error", "message": "Unknown upload"}, 404)
+            return
+        
+        error = upload_error(params.get('sessionId', [''])[0], upload)
+        if error:
+            self.send_json({"status": "error", "message": error})
+            return
+        self.send_json({"status": "ok", "offset": upload["offset"], "fileSize": upload["fileSize"]})
+    
+    def upload_finalize(self):
+        data = self.body
+        
+        upload_id = data.get("uploadId", "")
+        if not isinstance(upload_id, str):
+            self.send_json({"status": "error", "message": "Invalid uploadId"}, 400)
+            return
+        
+        upload = load_upload(upload_id)
+        if upload is None:
+            self.send_json({"status": "error", "message": "Unknown upload"}, 404)
+            return
+        
+        error = upload_error(data.get("sessionId"), upload)
+        if error:
+            self.send_json({"status": "error", "message": error})
+            return
+        
+        with upload_lock(upload_id):
+            upload = load_upload(upload_id)
+            if upload is None:
+                self.send_json({"status": "error", "message": "Unknown upload"}, 404)
+                return
+            
+            if upload["offset"] != upload["fileSize"]:
+                self.send_json({"status": "error", "message": "Upload incomplete", "offset": upload["offset"]}, 409)
+                return
+            
+            try:
+                finalize_upload(upload)
+            except OSError:
+                self.send_json({"status": "error", "message": "Failed to save file"})
+                return
+        
+        self.send_json({"status": "ok", "fileId": upload["fileId"]})
+    
+    def upload_raw(self, parsed):
+        """Single-request streaming upload; file details travel in the query string"""
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        username = params.get("username")
+        channel = params.get("channel", "general")
+        length = self.content_length()
+        
+        if length is None:
+            self.send_json({"status": "error", "message": "Content-Length required"}, 411)
+            return
+        if length > MAX_FILE_SIZE:
+            self.send_json({"status": "error", "message": "File too large. Maximum size is 100MB."}, 413)
+            return
+        
+        error = posting_error(params.get("sessionId"), username, channel)
+        if error:
+            self.send_json({"status": "error", "message": error})
+            return
+        
+        upload = create_upload(username, channel, params.get("id"), params.get("fileName"), length,
+                               params.get("mimeType") or self.headers.get('Content-Type'),
+                               params.get("type"), params.get("color"))
+        with upload_lock(upload["uploadId"]):
+            _, part_path = upload_paths(upload["uploadId"])
+            with open(part_path, 'ab') as f:
+                written = self.copy_body(f, length, upload_hasher(upload["uploadId"], 0))
+            if written != length:
+                self.send_json({"status": "error", "message": "Upload incomplete",
+                                "uploadId": upload["uploadId"], "offset": written}, 409)
+                return
+            upload["offset"] = written
+            try:
+                finalize_upload(upload)
+            except OSError:
+                self.send_json({"status": "error", "message": "Failed to save file"})
+                return
+        
+        self.send_json({"status": "ok", "fileId": upload["fileId"]})
     
     def get_file(self, path):
         file_id = path.split('/')[-1]
-        file_path = os.path.join(FILES_DIR, file_id)
-        metadata_path = file_path + ".meta"
+        if safe_file_id(file_id) != file_id:
+            self.send_error(404)
+            return
+        metadata = file_metadata(file_id)
         
-        if not os.path.exists(file_path):
+        try:
+            f = open(blob_store.file_path(file_id, metadata), 'rb')
+        except OSError:
             self.send_error(404)
             return
         
-        mime_type = "application/octet-stream"
-        if os.path.exists(metadata_path):
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            mime_type = metadata.get("mimeType") or "application/octet-stream"
+            if metadata.get("sha256"):
+                etag = f'"{metadata["sha256"]}"'
+            else:
+                etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+            
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            
+            status, start, end = 200, 0, size - 1
+            range_header = self.headers.get('Range')
+            if range_header and self.headers.get('If-Range', etag) == etag:
+                byte_range = parse_range(range_header, size)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.end_headers()
+                    return
+                if byte_range:
+                    status = 206
+                    start, end = byte_range
+            
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header('Content-type', mime_type)
+            self.send_header('Content-Length', length)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
+            self.send_header('Cache-Control', f'private, max-age={FILE_CACHE_MAX_AGE}')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if not length:
+                return
+            
             try:
-                with open(metadata_path, 'r') as f:
-                    metadata = json.load(f)
-                    mime_type = metadata.get("mimeType", mime_type)
-            except:
+                self.wfile.written += self.connection.sendfile(f, start, length)
+            except (BrokenPipeError, ConnectionResetError):
                 pass
+    
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+    
+    def delete_message(self):
+        data = self.body
         
-        try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-        except:
-            self.send_error(500)
+        session_id = data.get("sessionId")
+        if not session_id or sessions.get(session_id) is None:
+            self.send_json({"status": "error", "message": "Invalid session"})
             return
         
-        self.send_response(200)
-        self.send_header('Content-type', mime_type)
-        self.send_header('Content-Length', len(content))
-        self.end_headers()
-        self.wfile.write(content)
+        result = submit({"op": "delete", "channel": data.get("channel"), "id": data.get("messageId"),
+                         "username": data.get("username")})
+        if result.get("error"):
+            self.send_json({"status": "error", "message": result["error"]})
+            return
+        self.send_json({"status": "ok"})
     
-    def delete_message(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+    def get_message_by_id(self, parsed):
+        message_id = unquote(parsed.path[len('/api/message/'):])
+        params = parse_qs(parsed.query)
+        channel = params.get('channel', [None])[0]
         
-        session_id = data.get("sessionId")
-        if not session_id or session_id not in active_sessions:
+        names = [channel] if channel is not None else channel_names()
+        for name in names:
+            channel_data = get_channel(name)
+            if channel_data is None:
+                continue
+            with channel_data["lock"].read():
+                msg = get_message(channel_data, message_id)
+            if msg is not None:
+                self.send_json({"status": "ok", "channel": name, "message": msg.to_dict()})
+                return
+        
+        self.send_json({"status": "error", "message": "Message not found"}, 404)
+    
+    def search(self, parsed):
+        params = parse_qs(parsed.query)
+        session = sessions.get(params.get('session', [''])[0])
+        if session is None:
             self.send_json({"status": "error", "message": "Invalid session"})
             return
         
-        message_id = data.get("messageId")
-        channel = data.get("channel")
-        username = data.get("username")
+        terms = tokenize(params.get('q', [''])[0])
+        author = params.get('user', [None])[0]
+        if author:
+            terms.add("from:" + author.lower())
+        if not terms:
+            self.send_json({"status": "error", "message": "Empty search"})
+            return
+        try:
+            before = int(params['before'][0]) if 'before' in params else None
+            limit = min(max(int(params.get('limit', [SEARCH_PAGE_SIZE])[0]), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            self.send_json({"status": "error", "message": "Invalid cursor"})
+            return
+        
+        channel = params.get('channel', [None])[0]
+        names = [channel] if channel is not None else channel_names()
+        with moderation_lock.read():
+            blocked = user_restrictions.get(session["username"])
+            if blocked:
+                names = [name for name in names if name not in blocked]
         
-        with data_lock:
-            if channel in channels:
-                messages = channels[channel]["messages"]
-                for i, msg in enumerate(messages):
-                    if msg.get("id") == message_id:
-                        if msg.get("username") == username:
-                            if msg.get("fileId"):
-                                file_path = os.path.join(FILES_DIR, msg["fileId"])
-                                if os.path.exists(file_path):
-                                    try:
-                                        os.remove(file_path)
-                                    except:
-                                        pass
-                                metadata_path = file_path + ".meta"
-                                if os.path.exists(metadata_path):
-                                    try:
-                                        os.remove(metadata_path)
-                                    except:
-                                        pass
-                            
-                            messages.pop(i)
-                            save_messages()
-                            self.send_json({"status": "ok"})
-                            return
-                        else:
-                            self.send_json({"status": "error", "message": "Not authorized"})
-                            return
-        
-        self.send_json({"status": "error", "message": "Message not found"})
+        results = []
+        exhausted = False
+        while len(results) < limit and not exhausted:
+            wanted = limit - len(results)
+            hits = search_index.search(terms, names, before, wanted)
+            exhausted = len(hits) < wanted
+            for doc, name, seq in hits:
+                channel_data = get_channel(name)
+                msg = None
+                if channel_data is not None:
+                    with channel_data["lock"].read():
+                        if not channel_data["deleted"]:
+                            msg = message_at(channel_data, seq)
+                if msg is None:
+                    # Deleted since the index was last saved
+                    search_index.remove(name, seq)
+                else:
+                    results.append({"channel": name, "message": msg.to_dict()})
+                before = doc
+        
+        cursor = None if exhausted else before
+        self.send_json({"status": "ok", "results": results, "next": cursor})
     
     def heartbeat(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode())
+        data = self.body
+        
+        result = publish({"op": "touch", "id": data.get("sessionId")})
+        if result.get("error"):
+            self.send_json({"status": "error", "message": result["error"]})
+            return
+        self.send_json({"status": "ok"})
+    
+    def sync(self):
+        """Heartbeat plus everything the client is missing across channels, presence and the channel list"""
+        data = self.body
         
         session_id = data.get("sessionId")
+        result = publish({"op": "touch", "id": session_id})
+        if result.get("error"):
+            self.send_json({"status": "error", "message": result["error"]})
+            return
+        session = sessions.get(session_id)
+        if session is None:
+            # Expired between the touch and here
+            self.send_json({"status": "error", "message": "Invalid session"}, 401)
+            return
+        username = session["username"]
         
-        with data_lock:
-            if session_id in active_sessions:
-                active_sessions[session_id]["last_seen"] = datetime.now().timestamp()
-            else:
-                username = data.get("username")
-                if username in registered_users:
-                    active_sessions[session_id] = {
-                        "username": username,
-                        "last_seen": datetime.now().timestamp(),
-                        "color": data.get("color", registered_users[username]["color"])
-                    }
+        cursors = data.get("cursors")
+        if not isinstance(cursors, dict):
+            cursors = {}
+        try:
+            wait = min(max(float(data.get("wait") or 0), 0), MAX_LONG_POLL)
+        except (TypeError, ValueError):
+            wait = 0
+        if wait and not self.acquire_stream_slot():
+            wait = 0
+        deadline = time.monotonic() + wait
         
-        self.send_json({"status": "ok"})
+        try:
+            while True:
+                response, known = sync_response(username, cursors, data.get("channel"),
+                                                data.get("usersVersion"), data.get("channelsVersion"))
+                remaining = deadline - time.monotonic()
+                if response["updates"] or "users" in response or "channels" in response or remaining <= 0:
+                    break
+                # Look again every STREAM_PRESENCE_CHECK: users going offline isn't
+                # notified, and a waiting client is as good as a heartbeat
+                if not notifier.wait(known, min(remaining, STREAM_PRESENCE_CHECK)):
+                    publish({"op": "touch", "id": session_id})
+        finally:
+            if wait:
+                self.release_stream_slot()
+        
+        self.send_json(response)
+    
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
     
-    def send_json(self, data):
+    def send_cached(self, entry):
+        """Send a ResponseCache entry, or a 304 if the client already has it"""
+        if entry["gzip"] is not None and self.accepts_gzip():
+            body, etag = entry["gzip"], entry["gzip_etag"]
+        else:
+            body, etag = entry["body"], entry["etag"]
+        
+        if self.not_modified(etag, None):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if body is entry["gzip"]:
+            self.send_header('Content-Encoding', 'gzip')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
     
     def log_message(self, format, *args):
         pass
 
-def run_server(port=8000):
-    load_data()
-    
-    server = HTTPServer(('', port), ChatHandler)
+def reject_connection(conn):
+    """Turn a connection away with 503 when the request queue is full"""
+    try:
+        conn.sendall(b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n")
+    except OSError:
+        pass
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that hands accepted connections to a fixed pool of worker threads.
+
+    Connections wait in a bounded queue; once it is full new connections are
+    answered with 503 instead of piling up.
+    """
+
+    def __init__(self, server_address, handler_class, workers=WORKER_THREADS,
+                 queue_size=REQUEST_QUEUE_SIZE, max_streams=MAX_STREAMS, reuse_port=False):
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.stream_slots = BoundedSemaphore(max(1, max_streams))
+        self.workers = []
+        self.allow_reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        self.workers = [Thread(target=self.worker_loop, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            reject_connection(request)
+            self.shutdown_request(request)
+
+    def worker_loop(self):
+        while True:
+            request, client_address = self.requests.get()
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put((None, None))
+
+class PrefixedReader(io.RawIOBase):
+    """Raw reader that returns bytes already read off a socket before reading it again"""
+
+    def __init__(self, sock, prefix):
+        self.sock = sock
+        self.prefix = prefix
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            n = min(len(buffer), len(self.prefix))
+            buffer[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.sock.recv_into(buffer)
+
+class PrefetchedSocket:
+    """Socket wrapper so ChatHandler can parse a request head the event loop already read"""
+
+    def __init__(self, sock, prefix):
+        self.sock = sock
+        self.prefix = prefix
+
+    def makefile(self, mode='r', buffering=-1):
+        if 'r' in mode:
+            return io.BufferedReader(PrefixedReader(self.sock, self.prefix))
+        return self.sock.makefile(mode, buffering)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class AsyncioHTTPServer:
+    """Accepts connections and reads request heads on an asyncio event loop.
+
+    Slow or idle clients cost a coroutine rather than a thread; once a full
+    request head has arrived, the connection is handed to ChatHandler on a
+    worker pool, so routing is identical to the threaded engines.
+    """
+
+    def __init__(self, server_address, handler_class, workers=WORKER_THREADS,
+                 queue_size=REQUEST_QUEUE_SIZE, max_streams=MAX_STREAMS, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = workers + queue_size
+        self.pending = 0
+        self.stream_slots = BoundedSemaphore(max(1, max_streams))
+        self.socket = socket.create_server(server_address, backlog=queue_size, reuse_port=reuse_port)
+        self.socket.setblocking(False)
+
+    def serve_forever(self):
+        asyncio.run(self.accept_loop())
+
+    async def accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, client_address = await loop.sock_accept(self.socket)
+            loop.create_task(self.read_head(loop, conn, client_address))
+
+    async def read_head(self, loop, conn, client_address):
+        head = b""
+        try:
+            while b"\r\n\r\n" not in head:
+                chunk = await asyncio.wait_for(loop.sock_recv(conn, 65536), REQUEST_TIMEOUT)
+                if not chunk or len(head) > 65536:
+                    conn.close()
+                    return
+                head += chunk
+        except (asyncio.TimeoutError, OSError):
+            conn.close()
+            return
+        
+        if self.pending >= self.max_pending:
+            conn.setblocking(True)
+            reject_connection(conn)
+            conn.close()
+            return
+        
+        self.pending += 1
+        conn.setblocking(True)
+        future = loop.run_in_executor(self.executor, self.finish_request, conn, client_address, head)
+        future.add_done_callback(self.request_done)
+
+    def request_done(self, future):
+        self.pending -= 1
+
+    def finish_request(self, conn, client_address, head):
+        try:
+            self.RequestHandlerClass(PrefetchedSocket(conn, head), client_address, self)
+        except Exception as e:
+            print(f"Error handling request from {client_address[0]}: {e}")
+        finally:
+            try:
+                conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            conn.close()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def server_close(self):
+        self.socket.close()
+
+def make_server(port, engine=SERVER_ENGINE, workers=WORKER_THREADS, queue_size=REQUEST_QUEUE_SIZE,
+                reuse_port=False):
+    address = ('', port)
+    max_streams = min(MAX_STREAMS, workers // 2)
+    if engine == "threadpool":
+        return ThreadPoolHTTPServer(address, ChatHandler, workers, queue_size, max_streams, reuse_port)
+    if engine == "asyncio":
+        return AsyncioHTTPServer(address, ChatHandler, workers, queue_size, max_streams, reuse_port)
+    if engine == "threads":
+        server = ThreadingHTTPServer(address, ChatHandler, bind_and_activate=False)
+        server.allow_reuse_port = reuse_port
+        try:
+            server.server_bind()
+            server.server_activate()
+        except BaseException:
+            server.server_close()
+            raise
+        return server
+    raise ValueError(f"Unknown server engine: {engine}")
+
+def print_banner(port, engine, workers, queue_size, durability, flush_interval, processes=1):
     print(f"RyCord server running at http://localhost:{port}")
     print(f"Admin panel at http://localhost:{port}/admin")
     print(f"Admin password: {ADMIN_PASSWORD}")
     print(f"Data files:")
     print(f"   - Channels: {CHANNELS_FILE}")
     print(f"   - Banned users: {BANNED_USERS_FILE}")
-    print(f"   - Messages: {MESSAGES_FILE}")
+    print(f"   - Messages: {MESSAGES_DIR}")
     print(f"   - Users: {USERS_FILE}")
+    print(f"   - Search index: {SEARCH_FILE}")
+    print(f"   - Snapshot: {SNAPSHOT_FILE}")
+    print(f"Engine: {engine} ({workers} workers, queue of {queue_size})"
+          + (f" in each of {processes} processes" if processes > 1 else ""))
+    print(f"Durability: {durability}" + (f" (every {flush_interval}ms)" if durability == "interval" else ""))
     print(f"\nPress Ctrl+C to stop the server")
+
+def run_server(port=8000, engine=SERVER_ENGINE, workers=WORKER_THREADS, queue_size=REQUEST_QUEUE_SIZE,
+               durability=DURABILITY, flush_interval=FLUSH_INTERVAL_MS):
+    load_data()
+    blob_store.load()
+    static_cache.preload(STATIC_FILES)
+    
+    persistence.mode = durability
+    persistence.interval = flush_interval / 1000
+    persistence.start()
+    Thread(target=maintenance_loop, daemon=True).start()
+    
+    server = make_server(port, engine, workers, queue_size)
+    Thread(target=finish_loading, daemon=True).start()
+    print_banner(port, engine, workers, queue_size, durability, flush_interval)
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n\nSaving data...")
-        save_messages()
-        save_users()
-        save_channels()
-        save_banned_users()
-        save_restricted()
-        print("Server stopped. Thanks for using RyCord!")
         server.shutdown()
+        server.server_close()
+        persistence.mark("search", "snapshot")
+        persistence.close()
+        print("Server stopped. Thanks for using RyCord!")
+
+def run_worker(number, conn, port, engine, workers, queue_size):
+    """Serve requests in a forked worker, sending every change through the broker on conn"""
+    global cluster
+    cluster = ClusterLink(conn)
+    message_log.follower = True
+    Thread(target=cluster.run, daemon=True).start()
+    Thread(target=maintenance_loop, args=(False,), daemon=True).start()
+    
+    code = 0
+    try:
+        server = make_server(port, engine, workers, queue_size, reuse_port=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            server.shutdown()
+            server.server_close()
+    except Exception as e:
+        print(f"Worker {number} failed: {e}")
+        code = 1
+    sys.stdout.flush()
+    os._exit(code)
+
+def run_cluster(port=8000, processes=PROCESSES, engine=SERVER_ENGINE, workers=WORKER_THREADS,
+                queue_size=REQUEST_QUEUE_SIZE, durability=DURABILITY, flush_interval=FLUSH_INTERVAL_MS):
+    """Fork processes that all accept on port, with this one brokering their changes.
+
+    Everything is loaded before forking so the workers start with a full copy
+    of the state. Only this process writes the data files; the workers read
+    older history from the message logs as followers.
+    """
+    load_data()
+    finish_loading()
+    blob_store.load()
+    static_cache.preload(STATIC_FILES)
+    message_log.sync()
+    
+    pids = []
+    connections = []
+    for number in range(processes):
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            for other in connections:
+                other.close()
+            parent_end.close()
+            try:
+                run_worker(number, child_end, port, engine, workers, queue_size)
+            finally:
+                os._exit(1)
+        child_end.close()
+        pids.append(pid)
+        connections.append(parent_end)
+    
+    persistence.mode = durability
+    persistence.interval = flush_interval / 1000
+    persistence.start()
+    Thread(target=maintenance_loop, daemon=True).start()
+    print_banner(port, engine, workers, queue_size, durability, flush_interval, processes)
+    
+    broker = Broker(connections)
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        print("\n\nSaving data...")
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+        # Keep applying changes until the workers have finished their last requests
+        while True:
+            try:
+                broker.run()
+                break
+            except KeyboardInterrupt:
+                pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+    persistence.mark("search", "snapshot")
+    persistence.close()
+    print("Server stopped. Thanks for using RyCord!")
 
 if __name__ == '__main__':
-    run_server()
+    parser = argparse.ArgumentParser(description="RyCord messaging server")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--engine', choices=["threadpool", "asyncio", "threads"], default=SERVER_ENGINE)
+    parser.add_argument('--workers', type=int, default=WORKER_THREADS)
+    parser.add_argument('--queue-size', type=int, default=REQUEST_QUEUE_SIZE)
+    parser.add_argument('--processes', type=int, default=PROCESSES,
+                        help="server processes sharing the port; more than one needs SO_REUSEPORT")
+    parser.add_argument('--durability', choices=["strict", "interval", "shutdown"], default=DURABILITY)
+    parser.add_argument('--flush-interval', type=int, default=FLUSH_INTERVAL_MS, metavar='MS')
+    parser.add_argument('--migrate-files', action='store_true',
+                        help="move existing uploads into the deduplicated blob store and exit")
+    parser.add_argument('--build-snapshot', action='store_true',
+                        help="read every message log and write the startup snapshot and search index, then exit")
+    args = parser.parse_args()
+    if args.migrate_files:
+        migrate_files()
+    elif args.build_snapshot:
+        build_snapshot()
+    elif args.processes > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--processes needs SO_REUSEPORT, which this platform does not have")
+        run_cluster(args.port, args.processes, args.engine, args.workers, args.queue_size,
+                    args.durability, args.flush_interval)
+    else:
+        run_server(args.port, args.engine, args.workers, args.queue_size,
+                   args.durability, args.flush_interval)
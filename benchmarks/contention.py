@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Lock contention benchmark: how much do writes to one channel slow down
+reads of another?
+
+Starts RyCord on a scratch data directory, measures the latency of
+/api/messages reads on #general while idle, then again while several
+threads hammer #random with sends, and prints both. The send rate limits
+are lifted through the admin API first, since the writers would otherwise
+spend the run being refused with 429.
+
+    python3 benchmarks/contention.py [--readers 4] [--writers 8] [--seconds 5]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from threading import Thread, Event
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RyCord.py")
+
+def request(base, path, data=None):
+    body = None if data is None else json.dumps(data).encode()
+    req = urllib.request.Request(base + path, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as r:
+        return json.loads(r.read())
+
+def wait_for_server(base, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return request(base, "/api/channels")
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def measure_reads(base, readers, seconds, stop):
+    samples = []
+
+    def reader():
+        while not stop.is_set():
+            start = time.perf_counter()
+            request(base, "/api/messages?channel=general&limit=50")
+            samples.append(time.perf_counter() - start)
+
+    threads = [Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return samples
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix="rycord-bench-")
+    base = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, SERVER, "--port", str(args.port), "--workers", str(args.readers + args.writers + 4)],
+        cwd=data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_server(base)
+        admin = request(base, "/api/admin/login", {"password": "password"})["sessionId"]
+        request(base, "/api/admin/limits", {"sessionId": admin,
+                                            "limits": {"rates": {"send": {"session": None, "user": None}}}})
+        request(base, "/api/signup", {"username": "bench", "password": "bench"})
+        session = request(base, "/api/login", {"username": "bench", "password": "bench"})["sessionId"]
+        for i in range(200):
+            request(base, "/api/send", {"sessionId": session, "username": "bench",
+                                        "channel": "general", "text": f"history {i}"})
+
+        idle = measure_reads(base, args.readers, args.seconds, Event())
+
+        stop = Event()
+        sent = [0]
+
+        def writer():
+            while not stop.is_set():
+                request(base, "/api/send", {"sessionId": session, "username": "bench",
+                                            "channel": "random", "text": "x" * 200})
+                sent[0] += 1
+
+        writers = [Thread(target=writer) for _ in range(args.writers)]
+        for t in writers:
+            t.start()
+        busy = measure_reads(base, args.readers, args.seconds, stop)
+        for t in writers:
+            t.join()
+
+        print(f"{'':>22}{'reads':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        for label, samples in (("idle", idle), (f"{args.writers} writers on #random", busy)):
+            print(f"{label:>22}{len(samples):>8}{percentile(samples, 0.5) * 1000:>10.2f}"
+                  f"{percentile(samples, 0.99) * 1000:>10.2f}")
+        print(f"writes to #random: {sent[0] / args.seconds:.0f}/s")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    run(parser.parse_args())
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Load test: how does RyCord hold up as simulated clients are added?
+
+For each client count, starts a fresh RyCord on a scratch data directory
+and has that many simulated users sign up, log in and then behave like
+the polling web client. Every tick each one polls for new messages, the
+user list and the channel list, heartbeats every few ticks, and now and
+then sends, uploads, downloads or deletes. The user and channel polls
+revalidate with If-None-Match the way a browser would. With --sync each
+tick is a single /api/sync call instead, which also stands in for the
+heartbeat.
+
+Prints requests per second and p50/p95/p99 latency per route, the
+server's memory and the size of its data files, and saves all of it as
+JSON so runs can be compared across changes. The clients run in this
+process on one event loop, so on a small machine they compete with the
+server for CPU.
+
+    python3 benchmarks/loadtest.py [--clients 50 500 5000] [--seconds 30] [--output loadtest.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import quote
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVER = os.path.join(ROOT, "RyCord.py")
+
+# Chance per tick that a client does each of these on top of its polls
+DEFAULT_MIX = {"send": 0.05, "upload": 0.005, "download": 0.02, "delete": 0.01}
+
+class Client:
+    def __init__(self, port, timeout, stats):
+        self.port = port
+        self.timeout = timeout
+        self.stats = stats
+        self.etags = {}
+
+    async def request(self, route, method, path, data=None, body=None, headers=None):
+        """Make one request and record it under route; returns (status, parsed JSON or None)"""
+        if data is not None:
+            body = json.dumps(data).encode()
+        head = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1", "Connection: close"]
+        if body is not None:
+            head.append(f"Content-Length: {len(body)}")
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        started = time.perf_counter()
+        try:
+            raw = await asyncio.wait_for(self.exchange("\r\n".join(head).encode() + b"\r\n\r\n" + (body or b"")),
+                                         self.timeout)
+        except asyncio.TimeoutError:
+            self.stats.record(route, started, "timeout", 0)
+            return None, None
+        except OSError as e:
+            self.stats.record(route, started, type(e).__name__, 0)
+            return None, None
+
+        header, _, payload = raw.partition(b"\r\n\r\n")
+        lines = header.decode("latin-1").split("\r\n")
+        try:
+            status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            self.stats.record(route, started, "bad response", len(raw))
+            return None, None
+        response_headers = dict(line.split(": ", 1) for line in lines[1:] if ": " in line)
+        if "ETag" in response_headers:
+            self.etags[path] = response_headers["ETag"]
+
+        result = None
+        if payload and response_headers.get("Content-type", "").startswith("application/json"):
+            try:
+                result = json.loads(payload)
+            except ValueError:
+                pass
+        outcome = status
+        if status < 400 and isinstance(result, dict) and result.get("status") == "error":
+            outcome = "error: " + str(result.get("message"))
+        self.stats.record(route, started, outcome, len(raw))
+        return status, result
+
+    async def exchange(self, request):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            writer.write(request)
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def revalidate(self, route, path):
+        etag = self.etags.get(path)
+        return await self.request(route, "GET", path, headers={"If-None-Match": etag} if etag else None)
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+        self.bytes = defaultdict(int)
+
+    def record(self, route, started, outcome, size):
+        self.latencies[route].append(time.perf_counter() - started)
+        self.outcomes[route][str(outcome)] += 1
+        self.bytes[route] += size
+
+    def summary(self, seconds):
+        routes = {}
+        for route, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            ok = sum(count for outcome, count in self.outcomes[route].items() if outcome in ("200", "206", "304"))
+            routes[route] = {
+                "requests": len(samples),
+                "ok": ok,
+                "per_second": len(samples) / seconds,
+                "p50_ms": percentile(ordered, 0.50) * 1000,
+                "p95_ms": percentile(ordered, 0.95) * 1000,
+                "p99_ms": percentile(ordered, 0.99) * 1000,
+                "bytes_in": self.bytes[route],
+                "outcomes": dict(self.outcomes[route])
+            }
+        return routes
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+async def simulate_user(number, args, stats, stop, shared):
+    client = Client(args.port, args.timeout, stats)
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    username, password = f"load{number}", "loadtest"
+    await client.request("POST /api/signup", "POST", "/api/signup", {"username": username, "password": password})
+    _, login = await client.request("POST /api/login", "POST", "/api/login", {"username": username, "password": password})
+    if not login or login.get("status") != "ok":
+        return
+    session, color = login["sessionId"], login["color"]
+    channel = random.choice(["general", "random"])
+    since = 0
+    cursors, versions = {}, {}
+    sent = []
+    tick = 0
+
+    while not stop.is_set():
+        started = time.monotonic()
+        if args.sync:
+            _, data = await client.request("POST /api/sync", "POST", "/api/sync", {
+                "sessionId": session, "channel": channel, "cursors": cursors, **versions
+            })
+            if data and data.get("status") == "ok":
+                for name, update in data["updates"].items():
+                    cursors[name] = update["seq"]
+                    shared["files"].extend(msg["fileId"] for msg in update.get("messages", []) if msg.get("fileId"))
+                for name in ("usersVersion", "channelsVersion"):
+                    if name in data:
+                        versions[name] = data[name]
+        else:
+            _, data = await client.request("GET /api/messages", "GET",
+                                           f"/api/messages?channel={channel}&since={since}")
+            if data and "seq" in data:
+                since = data["seq"]
+                shared["files"].extend(msg["fileId"] for msg in data["messages"] if msg.get("fileId"))
+            await client.revalidate("GET /api/users", "/api/users")
+            await client.revalidate("GET /api/channels", "/api/channels")
+            if tick % 3 == 0:
+                await client.request("POST /api/heartbeat", "POST", "/api/heartbeat", {"sessionId": session})
+        del shared["files"][:-100]
+
+        if random.random() < args.mix["send"]:
+            _, result = await client.request("POST /api/send", "POST", "/api/send", {
+                "sessionId": session, "username": username, "channel": channel,
+                "text": "load test " * random.randint(1, 20), "color": color, "type": "text"
+            })
+            if result and result.get("id"):
+                sent.append(result["id"])
+        if random.random() < args.mix["upload"]:
+            size = random.randint(1, args.upload_kb) * 1024
+            await client.request("POST /api/upload/raw", "POST",
+                                 f"/api/upload/raw?sessionId={session}&username={quote(username)}"
+                                 f"&channel={channel}&fileName=load.bin&type=file",
+                                 body=os.urandom(size), headers={"Content-Type": "application/octet-stream"})
+        if random.random() < args.mix["download"] and shared["files"]:
+            await client.request("GET /api/file/<id>", "GET", "/api/file/" + random.choice(shared["files"]))
+        if random.random() < args.mix["delete"] and sent:
+            await client.request("POST /api/delete", "POST", "/api/delete", {
+                "sessionId": session, "username": username, "channel": channel,
+                "messageId": sent.pop(random.randrange(len(sent)))
+            })
+
+        tick += 1
+        try:
+            await asyncio.wait_for(stop.wait(), max(args.interval - (time.monotonic() - started), 0))
+        except asyncio.TimeoutError:
+            pass
+
+async def drive(args, clients):
+    stats = Stats()
+    stop = asyncio.Event()
+    shared = {"files": []}
+    users = [asyncio.create_task(simulate_user(n, args, stats, stop, shared)) for n in range(clients)]
+    await asyncio.sleep(args.ramp + args.seconds)
+    stop.set()
+    await asyncio.gather(*users)
+    return stats
+
+def process_memory(pid):
+    """Resident and peak resident memory of a process in MB, from /proc"""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    memory["rss_mb" if name == "VmRSS" else "peak_rss_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return memory
+
+def data_sizes(data_dir):
+    """Bytes on disk under each entry of the data directory"""
+    sizes = {}
+    root = os.path.join(data_dir, "rycord_data")
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path):
+            sizes[name] = sum(os.path.getsize(os.path.join(folder, file))
+                              for folder, _, files in os.walk(path) for file in files)
+        else:
+            sizes[name] = os.path.getsize(path)
+    return sizes
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    client = Client(port, 5, Stats())
+    while time.monotonic() < deadline:
+        status, _ = asyncio.run(client.request("startup", "GET", "/api/channels"))
+        if status == 200:
+            return
+        time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+def run_once(args, clients):
+    data_dir = tempfile.mkdtemp(prefix="rycord-load-")
+    server = subprocess.Popen(
+        [sys.executable, SERVER, "--port", str(args.port), "--engine", args.engine,
+         "--workers", str(args.workers), "--queue-size", str(args.queue_size),
+         "--durability", args.durability, "--processes", str(args.processes)],
+        cwd=data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_server(args.port)
+        started = time.perf_counter()
+        stats = asyncio.run(drive(args, clients))
+        elapsed = time.perf_counter() - started
+        memory = process_memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    try:
+        sizes = data_sizes(data_dir)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    routes = stats.summary(elapsed)
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "clients": clients,
+        "seconds": elapsed,
+        "requests": total,
+        "per_second": total / elapsed,
+        "routes": routes,
+        "memory": memory,
+        "data_bytes": sizes
+    }
+
+def report(result):
+    print(f"\n{result['clients']} clients: {result['per_second']:.0f} requests/s over {result['seconds']:.0f}s")
+    print(f"{'route':>22}{'requests':>10}{'ok':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, route in result["routes"].items():
+        print(f"{name:>22}{route['requests']:>10}{route['ok']:>8}{route['per_second']:>9.1f}"
+              f"{route['p50_ms']:>9.1f}{route['p95_ms']:>9.1f}{route['p99_ms']:>9.1f}")
+    memory = result["memory"]
+    if memory:
+        print(f"server memory: {memory.get('rss_mb', 0):.0f} MB resident, {memory.get('peak_rss_mb', 0):.0f} MB peak")
+    print("data files: " + ", ".join(f"{name} {size / 1024:.0f} KB" for name, size in result["data_bytes"].items()))
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, text.split(",")):
+        name, _, value = item.partition("=")
+        if name not in mix:
+            raise argparse.ArgumentTypeError(f"unknown action {name!r}; choose from {', '.join(mix)}")
+        mix[name] = float(value)
+    return mix
+
+def run(args):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    results = {
+        "started": datetime.now().isoformat(),
+        "revision": git_revision(),
+        "config": {name: value for name, value in vars(args).items() if name != "output"},
+        "runs": []
+    }
+    for clients in args.clients:
+        result = run_once(args, clients)
+        report(result)
+        results["runs"].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved {args.output}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[50, 500])
+    parser.add_argument('--seconds', type=float, default=30, help="how long to measure once everyone is in")
+    parser.add_argument('--ramp', type=float, default=5, help="seconds over which clients log in")
+    parser.add_argument('--interval', type=float, default=1, help="seconds between a client's polls")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="chance per tick of each action, e.g. send=0.1,upload=0")
+    parser.add_argument('--sync', action='store_true', help="poll with /api/sync instead of separate requests")
+    parser.add_argument('--upload-kb', type=int, default=256, help="largest upload")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--engine', default="threadpool")
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--queue-size', type=int, default=128)
+    parser.add_argument('--durability', default="interval")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--output', default="loadtest.json")
+    run(parser.parse_args())
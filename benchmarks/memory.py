@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: bytes per message of a channel's in-memory history.
+
+Writes a channel log of N messages to a scratch data directory, then
+measures with tracemalloc what holding that channel costs:
+
+- dicts: every message resident as a dict, as RyCord used to keep them
+- compact: every message resident as a Message (slots, interned fields)
+- hot tail: what the server keeps now, the last HOT_HISTORY messages
+  resident and the rest as seq and id hash arrays, with an id hash index
+
+    python3 benchmarks/memory.py [--messages 1000000]
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def generate(log, count):
+    users = [(f"user{i}", random.choice(["#ed4245", "#43b581", "#5865f2", "#e91e63"])) for i in range(50)]
+    start = time.time() - count
+
+    def records():
+        for seq in range(1, count + 1):
+            username, color = random.choice(users)
+            yield {
+                "id": uuid.uuid4().hex,
+                "username": username,
+                "text": "message text " * random.randint(1, 5),
+                "timestamp": datetime.fromtimestamp(start + seq).isoformat(),
+                "color": color,
+                "type": "text",
+                "seq": seq
+            }
+
+    base = log.begin_compaction("bench")
+    log.write_base("bench", base, records(), count)
+    return log._segment_path("bench", base)
+
+def measure(label, count, load):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    held = load()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{label:>10}{used / 2**20:>12.1f}{used / count:>12.1f}{elapsed:>10.1f}")
+    del held
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix="rycord-bench-")
+    os.chdir(data_dir)
+    sys.path.insert(0, ROOT)
+    import RyCord
+
+    try:
+        path = generate(RyCord.message_log, args.messages)
+        print(f"{args.messages} messages, {os.path.getsize(path) / 2**20:.0f} MB on disk")
+        print(f"{'':>10}{'MB':>12}{'B/message':>12}{'seconds':>10}")
+
+        def resident(convert):
+            messages = []
+            with open(path, 'rb') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record.get("op") == "add":
+                        messages.append(convert(record["msg"]))
+            seqs = [(m["seq"] if isinstance(m, dict) else m.seq) for m in messages]
+            index = {(m["id"] if isinstance(m, dict) else m.id): i for i, m in enumerate(messages)}
+            return messages, seqs, index
+
+        def hot_tail():
+            log = RyCord.MessageLog(RyCord.MESSAGES_DIR)
+            RyCord.message_log = log
+            channel_data = RyCord.new_channel("bench")
+            RyCord.load_history(channel_data, *log.load("bench"))
+            return log, channel_data
+
+        measure("dicts", args.messages, lambda: resident(lambda msg: msg))
+        measure("compact", args.messages, lambda: resident(RyCord.Message.from_dict))
+        measure("hot tail", args.messages, hot_tail)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    run(parser.parse_args())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: how long until a restarted server is useful again.
+
+Writes channel logs holding N messages in total to a scratch data
+directory, then starts RyCord on it and times, from launch:
+
+- listening: the port accepts connections
+- first page: /api/messages answers for one channel
+- all loaded: every channel's history is read and the search index caught up
+
+once with no snapshot (every log replayed, search index built from
+scratch) and once after --build-snapshot has written the snapshot and
+search index.
+
+    python3 benchmarks/startup.py [--messages 1000000] [--channels 20]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from datetime import datetime
+from threading import Thread
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVER = os.path.join(ROOT, "RyCord.py")
+WORDS = "the quick brown fox jumps over lazy dogs while chat servers restart".split()
+
+def generate(data_dir, messages, channel_count):
+    os.chdir(data_dir)
+    sys.path.insert(0, ROOT)
+    import RyCord
+
+    names = [f"channel{i}" for i in range(channel_count)]
+    users = [f"user{i}" for i in range(50)]
+    start = time.time() - messages
+    for i, name in enumerate(names):
+        count = messages // channel_count + (i < messages % channel_count)
+
+        def records():
+            for seq in range(1, count + 1):
+                yield {
+                    "id": uuid.uuid4().hex,
+                    "username": random.choice(users),
+                    "text": " ".join(random.choices(WORDS, k=random.randint(3, 12))),
+                    "timestamp": datetime.fromtimestamp(start + seq).isoformat(),
+                    "color": "#5865f2",
+                    "type": "text",
+                    "seq": seq
+                }
+
+        base = RyCord.message_log.begin_compaction(name)
+        RyCord.message_log.write_base(name, base, records(), count)
+    RyCord.message_log.sync()
+    RyCord.write_json(RyCord.CHANNELS_FILE, names)
+    return names
+
+def wait_for_port(port, deadline):
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError("server did not start")
+
+def start_server(data_dir, port, timeout):
+    """Launch the server; returns (process, {milestone: seconds after launch})"""
+    times = {}
+    started = time.monotonic()
+    server = subprocess.Popen(
+        [sys.executable, SERVER, "--port", str(port)], cwd=data_dir,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        env=dict(os.environ, PYTHONUNBUFFERED="1")
+    )
+
+    def watch():
+        for line in server.stdout:
+            if line.startswith("Loaded "):
+                times["all loaded"] = time.monotonic() - started
+
+    watcher = Thread(target=watch, daemon=True)
+    watcher.start()
+    deadline = started + timeout
+    wait_for_port(port, deadline)
+    times["listening"] = time.monotonic() - started
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/messages?channel=channel0&limit=50") as r:
+        r.read()
+    times["first page"] = time.monotonic() - started
+    while "all loaded" not in times and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return server, times
+
+def stop(server):
+    server.terminate()
+    server.wait()
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix="rycord-bench-")
+    try:
+        names = generate(data_dir, args.messages, args.channels)
+        print(f"{args.messages} messages in {len(names)} channels")
+        snapshot = os.path.join(data_dir, "rycord_data", "snapshot.bin")
+        search = os.path.join(data_dir, "rycord_data", "search.idx")
+        milestones = ("listening", "first page", "all loaded")
+        print(f"{'':>16}" + "".join(f"{m:>14}" for m in milestones))
+
+        for label in ("no snapshot", "snapshot"):
+            if label == "snapshot":
+                subprocess.run([sys.executable, SERVER, "--build-snapshot"], cwd=data_dir,
+                               stdout=subprocess.DEVNULL, check=True)
+            else:
+                for path in (snapshot, search):
+                    if os.path.exists(path):
+                        os.remove(path)
+            server, times = start_server(data_dir, args.port, args.timeout)
+            stop(server)
+            print(f"{label:>16}" + "".join(
+                f"{times[m]:>13.2f}s" if m in times else f"{'-':>14}" for m in milestones))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--timeout', type=float, default=600)
+    run(parser.parse_args())
@@ -0,0 +1,249 @@
+"""
+End-to-end checks against a server running in-process on a scratch data
+directory.
+
+    python3 -m unittest discover tests
+"""
+
+import http.client
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from threading import Thread
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RyCord = None
+server = None
+data_dir = None
+start_dir = None
+
+def setUpModule():
+    global RyCord, server, data_dir, start_dir
+    start_dir = os.getcwd()
+    data_dir = tempfile.mkdtemp(prefix="rycord-test-")
+    os.chdir(data_dir)
+    sys.path.insert(0, ROOT)
+    import RyCord as module
+    RyCord = module
+    RyCord.persistence.mode = "shutdown"
+    RyCord.load_data()
+    RyCord.finish_loading()
+    RyCord.blob_store.load()
+    server = RyCord.make_server(0, "threadpool", 8, 16)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+def tearDownModule():
+    server.shutdown()
+    server.server_close()
+    os.chdir(start_dir)
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+def request(method, path, body=None, headers=None):
+    """(status, headers, body bytes) of one request on a fresh connection"""
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+    try:
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        conn.close()
+
+def post_json(path, data):
+    return json.loads(request("POST", path, data)[2])
+
+def session(username):
+    post_json("/api/signup", {"username": username, "password": "password"})
+    return post_json("/api/login", {"username": username, "password": "password"})["sessionId"]
+
+class MessagesTest(unittest.TestCase):
+
+    def test_non_positive_limit_is_rejected(self):
+        session_id = session("pager")
+        for text in ("one", "two"):
+            post_json("/api/send", {"sessionId": session_id, "username": "pager", "channel": "general", "text": text})
+        for limit in ("-5", "0"):
+            status, _, body = request("GET", f"/api/messages?channel=general&since=0&limit={limit}")
+            self.assertEqual(status, 400)
+            self.assertEqual(json.loads(body)["message"], "Invalid limit")
+        status, _, body = request("GET", "/api/messages?channel=general&since=0&limit=1")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)["messages"]), 1)
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(RyCord.page_size(-5), 1)
+        self.assertEqual(RyCord.page_size(None), RyCord.MAX_PAGE_SIZE)
+        self.assertEqual(RyCord.page_size(10 ** 9), RyCord.MAX_PAGE_SIZE)
+
+class SearchTermsTest(unittest.TestCase):
+
+    def test_non_string_fields_are_rejected(self):
+        session_id = session("typist")
+        status, _, body = request("POST", "/api/send", {"sessionId": session_id, "username": "typist",
+                                                        "channel": "general", "text": 5})
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body)["message"], "Invalid text")
+        status, _, body = request("POST", "/api/upload/init", {"sessionId": session_id, "username": "typist",
+                                                               "channel": "general", "fileName": 5, "fileSize": 1})
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body)["message"], "Invalid fileName")
+        result = post_json("/api/send", {"sessionId": session_id, "username": "typist", "channel": "general",
+                                         "text": "still indexed"})
+        self.assertEqual(result["status"], "ok")
+        self.assertTrue(RyCord.search_index.search({"indexed"}, ["general"]))
+
+    def test_logged_non_string_fields_are_indexed(self):
+        message = RyCord.Message("legacy", "typist", 5, 0, "#5865f2", "file", file_name=["a"])
+        self.assertEqual(RyCord.message_terms(message), {"5", "a", "from:typist"})
+
+class AdminTest(unittest.TestCase):
+
+    def test_profiler_interval_must_be_finite(self):
+        admin = post_json("/api/admin/login", {"password": RyCord.ADMIN_PASSWORD})["sessionId"]
+        for interval in ("nan", "inf", "fast"):
+            status, _, body = request("POST", "/api/admin/profile", {"sessionId": admin, "enabled": True,
+                                                                      "interval": interval})
+            self.assertEqual(status, 400)
+            self.assertEqual(json.loads(body)["message"], "Invalid interval")
+        self.assertFalse(RyCord.profiler.summary()["running"])
+
+    def test_malformed_admin_data_is_rejected(self):
+        admin = post_json("/api/admin/login", {"password": RyCord.ADMIN_PASSWORD})["sessionId"]
+        before = RyCord.channel_names()
+        for edit in ({"channels": "general"}, {"banned_users": [1]}, {"restricted_channels": ["general"]},
+                     {"restricted_channels": {"general": "bob"}}):
+            status, _, body = request("POST", "/api/admin/data", dict(edit, sessionId=admin))
+            self.assertEqual(status, 400)
+            self.assertEqual(json.loads(body)["message"], "Invalid admin data")
+        self.assertEqual(RyCord.channel_names(), before)
+
+    def test_unknown_methods_share_one_metric_series(self):
+        for method in ("FOO1", "FOO2"):
+            # Read to EOF so the server has recorded the request
+            with socket.create_connection(server.server_address[:2], timeout=10) as sock:
+                sock.sendall(f"{method} /api/channels HTTP/1.0\r\n\r\n".encode())
+                sock.makefile('rb').read()
+        with RyCord.metrics.lock:
+            methods = {dict(labels).get("method") for _, labels in RyCord.metrics.counters}
+        self.assertIn("other", methods)
+        self.assertFalse({"FOO1", "FOO2"} & methods)
+
+class SyncTest(unittest.TestCase):
+
+    def test_session_expiring_mid_request_is_rejected(self):
+        session_id = session("syncer")
+        # The touch succeeds, then the session is gone by the time sync looks it up
+        with mock.patch.object(RyCord.sessions, "get", return_value=None):
+            status, _, body = request("POST", "/api/sync", {"sessionId": session_id})
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body)["message"], "Invalid session")
+
+class RecreatedChannelTest(unittest.TestCase):
+
+    def send(self, session_id, text):
+        result = post_json("/api/send", {"sessionId": session_id, "username": "recreator", "channel": "recreated",
+                                         "text": text})
+        self.assertEqual(result["status"], "ok")
+
+    def test_saved_state_of_deleted_channel_is_not_reused(self):
+        session_id = session("recreator")
+        RyCord.submit({"op": "create_channel", "channel": "recreated"})
+        for i in range(3):
+            self.send(session_id, f"before {i}")
+        RyCord.save_snapshot()
+        RyCord.search_index.save()
+
+        # Deleted and created again, then a crash before either file is saved
+        RyCord.submit({"op": "delete_channel", "channel": "recreated"})
+        RyCord.submit({"op": "create_channel", "channel": "recreated"})
+        for i in range(5):
+            self.send(session_id, f"after {i}")
+        RyCord.message_log.sync()
+        RyCord.message_log.load_snapshot()
+        self.assertIsNone(RyCord.message_log._read_snapshot("recreated", RyCord.message_log._segments("recreated")))
+
+        index = RyCord.SearchIndex(RyCord.SEARCH_FILE)
+        self.assertTrue(index.load())
+        index.hold(["recreated"])
+        index.catch_up(["recreated"])
+        self.assertEqual(index.search({"before"}, ["recreated"]), [])
+        self.assertEqual(len(index.search({"after"}, ["recreated"])), 5)
+
+class UploadsTest(unittest.TestCase):
+
+    def upload(self, session_id, username, channel, file_id, content):
+        upload = post_json("/api/upload/init", {"sessionId": session_id, "username": username, "channel": channel,
+                                                "id": file_id, "fileName": "f.txt", "fileSize": len(content)})
+        request("POST", f"/api/upload/chunk?uploadId={upload['uploadId']}&offset=0&sessionId={session_id}", content)
+        return post_json("/api/upload/finalize", {"uploadId": upload["uploadId"], "sessionId": session_id})
+
+    def test_rejected_file_message_keeps_no_reference(self):
+        session_id = session("uploader")
+        self.assertEqual(self.upload(session_id, "uploader", "general", "taken-id", b"first")["status"], "ok")
+        metadata = RyCord.blob_store.read_metadata("taken-id")
+        other = session("other")
+        self.upload(other, "other", "general", "taken-id", b"second")
+        self.upload(session_id, "uploader", "no-such-channel", "orphan-id", b"third")
+        self.assertEqual(RyCord.blob_store.read_metadata("taken-id"), metadata)
+        self.assertEqual(RyCord.blob_store.read_metadata("orphan-id"), {})
+        with RyCord.blob_store.lock:
+            self.assertEqual(RyCord.blob_store.refs.get(metadata["sha256"]), 1)
+            for content in (b"second", b"third"):
+                self.assertNotIn(RyCord.hashlib.sha256(content).hexdigest(), RyCord.blob_store.refs)
+
+    def test_unknown_uploads_leave_no_state(self):
+        session_id = session("uploader")
+        for upload_id in ("missing", "../../etc", ""):
+            status, _, _ = request("POST", f"/api/upload/chunk?uploadId={upload_id}&offset=0&sessionId={session_id}", b"x")
+            self.assertEqual(status, 404)
+        status, _, _ = request("POST", "/api/upload/finalize", {"uploadId": ["missing"], "sessionId": session_id})
+        self.assertEqual(status, 400)
+        self.assertEqual(RyCord.upload_locks, {})
+
+    def test_finished_upload_is_forgotten(self):
+        session_id = session("uploader")
+        upload = post_json("/api/upload/init", {"sessionId": session_id, "username": "uploader", "channel": "general",
+                                                "fileName": "a.txt", "fileSize": 5, "mimeType": "text/plain"})
+        upload_id = upload["uploadId"]
+        status, _, _ = request("POST", f"/api/upload/chunk?uploadId={upload_id}&offset=0", b"hello")
+        self.assertEqual(status, 200)
+        status_path = f"/api/upload/status?uploadId={upload_id}"
+        self.assertEqual(json.loads(request("GET", status_path)[2])["message"], "Invalid session")
+        other = session("other")
+        self.assertEqual(json.loads(request("GET", f"{status_path}&sessionId={other}")[2])["message"], "Unknown upload")
+        status, _, body = request("POST", f"/api/upload/chunk?uploadId={upload_id}&offset=0&sessionId={other}", b"hello")
+        self.assertEqual(json.loads(body)["message"], "Unknown upload")
+        self.assertEqual(json.loads(request("GET", f"{status_path}&sessionId={session_id}")[2])["offset"], 0)
+        status, _, body = request("POST", f"/api/upload/chunk?uploadId={upload_id}&offset=0&sessionId={session_id}", b"hello")
+        self.assertEqual(json.loads(body)["offset"], 5)
+        self.assertEqual(post_json("/api/upload/finalize", {"uploadId": upload_id, "sessionId": session_id})["status"], "ok")
+        self.assertNotIn(upload_id, RyCord.upload_locks)
+        self.assertNotIn(upload_id, RyCord.upload_hashers)
+
+    def test_zero_byte_file_downloads(self):
+        session_id = session("uploader")
+        upload = post_json("/api/upload/init", {"sessionId": session_id, "username": "uploader", "channel": "general",
+                                                "id": "empty-file", "fileName": "empty.txt", "fileSize": 0,
+                                                "mimeType": "text/plain"})
+        result = post_json("/api/upload/finalize", {"uploadId": upload["uploadId"], "sessionId": session_id})
+        self.assertEqual(result["status"], "ok")
+        with mock.patch.object(server, "handle_error") as handle_error:
+            # Read to EOF so the server has finished with the request before checking for errors
+            with socket.create_connection(server.server_address[:2], timeout=10) as sock:
+                sock.sendall(f"GET /api/file/{result['fileId']} HTTP/1.0\r\n\r\n".encode())
+                response = sock.makefile('rb').read()
+        head, _, body = response.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.0 200"))
+        self.assertIn(b"Content-Length: 0", head)
+        self.assertEqual(body, b"")
+        handle_error.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()